@@ -0,0 +1,153 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Benchmark suite: a deterministic generator of Online-Retail-style transactions in the data.csv schema, and a runner
+# that times every pipeline stage at several data sizes and compares the results against a stored baseline
+
+# Rows are generated and written in chunks of this size, so 50M rows never have to be held in memory
+GENERATOR_CHUNK_ROWS = 1_000_000
+
+# Non-product stock codes of the real export (postage, manual, discount, bank charges, carriage)
+SERVICE_PRODUCTS = [('POST', 'POSTAGE'), ('M', 'Manual'), ('D', 'Discount'), ('BANK CHARGES', 'Bank Charges'),
+                    ('DOT', 'DOTCOM POSTAGE'), ('23444', 'Next Day Carriage')]
+COUNTRIES = ['United Kingdom', 'Germany', 'France', 'EIRE', 'Spain', 'Netherlands', 'Belgium', 'Switzerland', 'Portugal', 'Australia']
+COUNTRY_WEIGHTS = [0.89, 0.025, 0.022, 0.02, 0.01, 0.01, 0.008, 0.007, 0.005, 0.003]
+FIRST_INVOICE_NO = 536365
+FIRST_INVOICE_DATE = pd.Timestamp('2010-12-01')
+DAYS = 373
+
+
+def parse_size(size):
+    # '10k', '1M', '50M' or a plain number of rows
+    multipliers = {'k': 1_000, 'M': 1_000_000}
+    return int(float(size[:-1]) * multipliers[size[-1]]) if size[-1] in multipliers else int(size)
+
+
+def product_catalog(rng, n_products):
+    # Five-digit stock codes, some with a letter variant suffix, and descriptions in mixed case like the real export
+    numbers = 20000 + rng.choice(70000, n_products, replace=False)
+    suffixes = np.where(rng.random(n_products) < 0.15, rng.choice(list('ABCDEFGL'), n_products), '')
+    stock_codes = np.char.add(numbers.astype(str), suffixes)
+    descriptions = np.array(['PRODUCT {} {}'.format(number, 'VARIANT ' + suffix if suffix else 'ITEM') for number, suffix in zip(numbers, suffixes)])
+    descriptions = np.where(rng.random(n_products) < 0.02, np.char.title(descriptions), descriptions)
+    prices = np.round(rng.lognormal(mean=0.8, sigma=0.8, size=n_products), 2) + 0.01
+
+    # Append the service rows at the end of the catalog, they are drawn at a fixed small rate rather than by popularity
+    stock_codes = np.concatenate([stock_codes, [code for code, _ in SERVICE_PRODUCTS]])
+    descriptions = np.concatenate([descriptions, [description for _, description in SERVICE_PRODUCTS]])
+    prices = np.concatenate([prices, np.round(rng.uniform(1, 30, len(SERVICE_PRODUCTS)), 2)])
+    return stock_codes, descriptions, prices
+
+
+def power_law_weights(n, exponent):
+    # Zipf-like popularity: the item of rank r is drawn with probability proportional to r ** -exponent
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -exponent
+    return weights / weights.sum()
+
+
+def generate_transactions(n_rows, path, seed=0, n_products=4000, n_customers=None, lines_per_invoice=20, cancellation_rate=0.02,
+                          missing_customer_rate=0.2, chunk_rows=GENERATOR_CHUNK_ROWS):
+    # The catalog, customers and popularity come from the seed alone and every chunk from (seed, chunk index),
+    # so the same arguments always write the same file
+    rng = np.random.default_rng(seed)
+    n_customers = n_customers or max(100, n_rows // 120)
+    stock_codes, descriptions, prices = product_catalog(rng, n_products)
+    product_weights = power_law_weights(n_products, 0.7)
+    customer_ids = 12346 + rng.permutation(n_customers * 2)[:n_customers]
+    customer_weights = power_law_weights(n_customers, 0.8)
+    customer_countries = rng.choice(len(COUNTRIES), n_customers, p=COUNTRY_WEIGHTS)
+
+    invoice_offset = 0
+    with open(path, 'w', newline='') as file:
+        for chunk, start in enumerate(range(0, n_rows, chunk_rows)):
+            chunk_rng = np.random.default_rng([seed, chunk])
+            rows = min(chunk_rows, n_rows - start)
+
+            # Split the chunk into invoices of geometric length, each with one customer, country and timestamp
+            sizes = chunk_rng.geometric(1 / lines_per_invoice, size=rows // lines_per_invoice * 2 + 10)
+            n_invoices = int(np.searchsorted(np.cumsum(sizes), rows)) + 1
+            invoice = np.repeat(np.arange(n_invoices), sizes[:n_invoices])[:rows]
+            cancelled = chunk_rng.random(n_invoices) < cancellation_rate
+            invoice_numbers = np.char.add(np.where(cancelled, 'C', ''), (FIRST_INVOICE_NO + invoice_offset + np.arange(n_invoices)).astype(str))
+            customers = chunk_rng.choice(n_customers, n_invoices, p=customer_weights)
+            invoice_customer_ids = np.where(chunk_rng.random(n_invoices) < missing_customer_rate, np.nan, customer_ids[customers].astype(np.float64))
+
+            # Invoices move forward through the year with the rows, during shop hours
+            first_rows = np.searchsorted(invoice, np.arange(n_invoices))
+            days = ((start + first_rows) / n_rows * DAYS).astype(np.int64)
+            minutes = days * 24 * 60 + chunk_rng.integers(7 * 60, 20 * 60, n_invoices)
+            invoice_dates = (FIRST_INVOICE_DATE + pd.to_timedelta(minutes, unit='m')).strftime('%m/%d/%Y %H:%M').to_numpy()
+            invoice_offset += n_invoices
+
+            # Draw products by popularity, with service rows at a small fixed rate
+            products = chunk_rng.choice(n_products, rows, p=product_weights)
+            service = chunk_rng.random(rows) < 0.005
+            products[service] = n_products + chunk_rng.integers(0, len(SERVICE_PRODUCTS), int(service.sum()))
+            quantities = chunk_rng.geometric(0.15, rows) * np.where(chunk_rng.random(rows) < 0.05, 12, 1)
+            quantities = np.where(cancelled[invoice], -quantities, quantities)
+            unit_prices = np.where(chunk_rng.random(rows) < 0.001, 0.0, prices[products])
+
+            frame = pd.DataFrame({'InvoiceNo': invoice_numbers[invoice], 'StockCode': stock_codes[products],
+                                  'Description': np.where(chunk_rng.random(rows) < 0.002, None, descriptions[products]),
+                                  'Quantity': quantities, 'InvoiceDate': invoice_dates[invoice], 'UnitPrice': unit_prices,
+                                  'CustomerID': invoice_customer_ids[invoice],
+                                  'Country': np.array(COUNTRIES)[customer_countries[customers]][invoice]})
+
+            # Repeat a few lines within their invoice, like the duplicated rows of the real export
+            duplicates = np.sort(chunk_rng.choice(rows, rows // 200, replace=False))
+            frame = pd.concat([frame, frame.iloc[duplicates]]).sort_index(kind='stable').iloc[:rows]
+            frame.to_csv(file, header=chunk == 0, index=False)
+
+
+def run_size(size, data_dir, seed=0, trace_memory=False):
+    # Generate (or reuse) the input for this size, then run the whole pipeline in a fresh process with an empty cache,
+    # so every stage runs and the peak RSS belongs to this size only
+    n_rows = parse_size(size)
+    os.makedirs(data_dir, exist_ok=True)
+    data_path = os.path.join(data_dir, 'retail_{}_{}.csv'.format(n_rows, seed))
+    if not os.path.exists(data_path):
+        print('Generating {} rows into {}'.format(n_rows, data_path))
+        generate_transactions(n_rows, data_path + '.tmp', seed=seed)
+        os.replace(data_path + '.tmp', data_path)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        report_path = os.path.join(work_dir, 'report.json')
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recommend.py'), 'run',
+                   '--input', data_path, '--cache-dir', os.path.join(work_dir, 'cache'), '--output', os.path.join(work_dir, 'output.csv'),
+                   '--bundle', os.path.join(work_dir, 'model_bundle.pkl'), '--profile-report', report_path]
+        if not trace_memory:
+            command.append('--no-trace-memory')
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with open(report_path) as file:
+            report = json.load(file)
+
+    stages = {stage['stage']: {key: stage[key] for key in ['wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'rss_growth_mb', 'peak_traced_mb']}
+              for stage in report['stages'] if stage['depth'] == 0 and not stage['cached']}
+    return {'rows': n_rows, 'total_seconds': report['total_seconds'], 'peak_rss_mb': max(stage['peak_rss_mb'] for stage in stages.values()),
+            'stages': stages}
+
+
+def compare(results, baseline, threshold=0.25, min_seconds=0.05, min_mb=5.0):
+    # A stage regresses when its time or its own memory grew by more than the threshold, ignoring differences below the
+    # noise floor. Memory is judged on how far the stage raised the RSS above where it started (and on its traced peak when
+    # both runs traced memory), not on the process-wide peak, which a stage inherits from the stages before it
+    rows = []
+    for size, result in results.items():
+        for stage, metrics in result['stages'].items():
+            previous = baseline.get(size, {}).get('stages', {}).get(stage)
+            if previous is None:
+                continue
+            for metric, floor in [('wall_seconds', min_seconds), ('rss_growth_mb', min_mb), ('peak_traced_mb', min_mb)]:
+                if metrics.get(metric) is None or previous.get(metric) is None:
+                    continue
+                change = metrics[metric] / previous[metric] - 1 if previous[metric] else float('inf') if metrics[metric] else 0.0
+                regressed = change > threshold and metrics[metric] - previous[metric] > floor
+                rows.append({'Size': size, 'Stage': stage, 'Metric': metric, 'Baseline': previous[metric], 'Current': metrics[metric],
+                             'Change': change, 'Regression': regressed})
+    return pd.DataFrame(rows, columns=['Size', 'Stage', 'Metric', 'Baseline', 'Current', 'Change', 'Regression']).astype({'Regression': bool})
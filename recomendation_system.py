@@ -2,225 +2,862 @@
 import warnings
 warnings.filterwarnings('ignore')
 
-import numpy as np
+import hashlib
+import json
+import os
+import pickle
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
-from scipy.stats import linregress
-from sklearn.ensemble import IsolationForest
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from yellowbrick.cluster import KElbowVisualizer, SilhouetteVisualizer
-from sklearn.metrics import silhouette_score, calinski_harabasz_score, davies_bouldin_score
-from sklearn.cluster import KMeans
-from tabulate import tabulate
-from collections import Counter
+from pandas.api.types import union_categoricals
+from recommendation_server import recommendation_numbers
+from stage_profiler import peak_rss_mb
 
+# scipy and scikit-learn take seconds to import, so each stage imports what it needs when it runs
 
-class RecommendationSystem:
-    def __init__(self, file_path):
-        self.file_path = file_path
-        self.df = None
-        self.customer_data = None
-        self.customer_data_cleaned = None
-        self.customer_data_scaled = None
-        self.customer_data_pca = None
-        self.outliers_data = None
-        self.customer_data_with_recommendations = None
 
-    def load_data(self):
-        self.df = pd.read_csv(self.file_path, encoding="ISO-8859-1")
+# Schema of the transaction export; low-cardinality strings are loaded as categoricals
+TRANSACTION_DTYPES = {
+    'InvoiceNo': 'str',
+    'StockCode': 'category',
+    'Description': 'category',
+    'Quantity': 'int32',
+    'UnitPrice': 'float64',
+    'CustomerID': 'float64',
+    'Country': 'category',
+}
+INVOICE_DATE_FORMAT = '%m/%d/%Y %H:%M'
 
+# Compact mode also dictionary-encodes the invoice numbers, which repeat on every line item of an invoice
+COMPACT_TRANSACTION_DTYPES = dict(TRANSACTION_DTYPES, InvoiceNo='category')
 
-    def clean_data(self):
-        # Removing rows with missing values in 'CustomerID' and 'Description' columns
-        self.df = self.df.dropna(subset=['CustomerID', 'Description'])
-        
-        # Removing duplicate rows
-        self.df.drop_duplicates(inplace=True)
+# Compact mode stores the calendar helper columns in the smallest integer type that holds them
+COMPACT_CALENDAR_DTYPES = {'Day_Of_Week': 'int8', 'Hour': 'int8', 'Year': 'int16', 'Month': 'int8'}
 
-        # Filter out the rows with InvoiceNo starting with "C" and create a new column indicating the transaction status
-        self.df['Transaction_Status'] = np.where(self.df['InvoiceNo'].astype(str).str.startswith('C'), 'Cancelled', 'Completed')
+# Bump whenever clean_data changes so cached cleaned tables from older rules are not reused
+CLEANING_VERSION = 2
 
-        # Finding the number of numeric characters in each unique stock code
-        unique_stock_codes = self.df['StockCode'].unique()
+# Descriptions of service-related rows, which are not products
+SERVICE_RELATED_DESCRIPTIONS = ["Next Day Carriage", "High Resolution Image"]
 
-        # Finding and printing the stock codes with 0 and 1 numeric characters
-        anomalous_stock_codes = [code for code in unique_stock_codes if sum(c.isdigit() for c in str(code)) in (0, 1)]
 
-        # Removing rows with anomalous stock codes from the dataset
-        self.df = self.df[~self.df['StockCode'].isin(anomalous_stock_codes)]
+def factorize_column(values):
+    # Integer codes (-1 for missing) and distinct values of a column, reusing the categories of categorical columns
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), values.cat.categories
+    return pd.factorize(values)
 
-        service_related_descriptions = ["Next Day Carriage", "High Resolution Image"]
-        # Remove rows with service-related information in the description
-        self.df = self.df[~self.df['Description'].isin(service_related_descriptions)]
 
-        # Standardize the text to uppercase to maintain uniformity across the dataset
-        self.df['Description'] = self.df['Description'].str.upper()
+def missing_customer_or_description(df):
+    return (df['CustomerID'].isna() | df['Description'].isna()).to_numpy()
 
-        # Removing records with a unit price of zero to avoid potential data entry errors
-        self.df = self.df[self.df['UnitPrice'] > 0]
 
-        # Resetting the index of the cleaned dataset
-        self.df.reset_index(drop=True, inplace=True)
+def duplicate_rows(df):
+    return df.duplicated().to_numpy()
 
 
-    def feature_engineer(self):
-        # Convert InvoiceDate to datetime type
-        self.df['InvoiceDate'] = pd.to_datetime(self.df['InvoiceDate'])
+def anomalous_stock_codes(df):
+    # Stock codes with 0 or 1 numeric characters, counting the digits once per distinct code;
+    # the extra trailing entry is picked by code -1, so missing stock codes count as anomalous
+    codes, stock_codes = factorize_column(df['StockCode'])
+    digits = pd.Series(np.asarray(stock_codes, dtype=str)).str.count(r'\d').to_numpy()
+    return np.append(np.isin(digits, (0, 1)), True)[codes]
 
-        # Convert InvoiceDate to datetime and extract only the date
-        self.df['InvoiceDay'] = self.df['InvoiceDate'].dt.date
 
-        # Find the most recent purchase date for each customer
-        self.customer_data = self.df.groupby('CustomerID')['InvoiceDay'].max().reset_index()
+def service_related_descriptions(df):
+    codes, descriptions = factorize_column(df['Description'])
+    return np.append(descriptions.isin(SERVICE_RELATED_DESCRIPTIONS), False)[codes]
 
-        # Find the most recent date in the entire dataset
-        most_recent_date = self.df['InvoiceDay'].max()
-
-        # Convert InvoiceDay to datetime type before subtraction
-        self.customer_data['InvoiceDay'] = pd.to_datetime(self.customer_data['InvoiceDay'])
-        most_recent_date = pd.to_datetime(most_recent_date)
 
-        # Calculate the number of days since the last purchase for each customer
-        self.customer_data['Days_Since_Last_Purchase'] = (most_recent_date - self.customer_data['InvoiceDay']).dt.days
+def non_positive_unit_price(df):
+    # Records with a unit price of zero are potential data entry errors
+    return ~(df['UnitPrice'] > 0).to_numpy()
 
-        # Remove the InvoiceDay column
-        self.customer_data.drop(columns=['InvoiceDay'], inplace=True)
 
-        # Calculate the total number of transactions made by each customer
-        total_transactions = self.df.groupby('CustomerID')['InvoiceNo'].nunique().reset_index()
-        total_transactions.rename(columns={'InvoiceNo': 'Total_Transactions'}, inplace=True)
+# Cleaning rules in order; each returns a boolean mask of the rows it removes
+CLEANING_RULES = [
+    ('missing_customer_or_description', missing_customer_or_description),
+    ('duplicate_rows', duplicate_rows),
+    ('anomalous_stock_codes', anomalous_stock_codes),
+    ('service_related_descriptions', service_related_descriptions),
+    ('non_positive_unit_price', non_positive_unit_price),
+]
 
-        # Calculate the total number of products purchased by each customer
-        total_products_purchased = self.df.groupby('CustomerID')['Quantity'].sum().reset_index()
-        total_products_purchased.rename(columns={'Quantity': 'Total_Products_Purchased'}, inplace=True)
 
-        # Merge the new features into the customer_data dataframe
-        self.customer_data = pd.merge(self.customer_data, total_transactions, on='CustomerID')
-        self.customer_data = pd.merge(self.customer_data, total_products_purchased, on='CustomerID')
-
-        # Calculate the total spend by each customer
-        self.df['Total_Spend'] = self.df['UnitPrice'] * self.df['Quantity']
-        total_spend = self.df.groupby('CustomerID')['Total_Spend'].sum().reset_index()
+@contextmanager
+def atomic_output(path):
+    # Yield a temporary path next to `path` and move it into place only once it was written completely,
+    # so an interrupted run or a concurrent reader never sees a truncated file
+    temporary_path = path + '.tmp'
+    try:
+        yield temporary_path
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    os.replace(temporary_path, path)
 
-        # Calculate the average transaction value for each customer
-        average_transaction_value = total_spend.merge(total_transactions, on='CustomerID')
-        average_transaction_value['Average_Transaction_Value'] = average_transaction_value['Total_Spend'] / average_transaction_value['Total_Transactions']
 
-        # Merge the new features into the customer_data dataframe
-        self.customer_data = pd.merge(self.customer_data, total_spend, on='CustomerID')
-        self.customer_data = pd.merge(self.customer_data, average_transaction_value[['CustomerID', 'Average_Transaction_Value']], on='CustomerID')
+def write_pickle(value, path):
+    with atomic_output(path) as temporary_path:
+        with open(temporary_path, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
 
-        # Calculate the number of unique products purchased by each customer
-        unique_products_purchased = self.df.groupby('CustomerID')['StockCode'].nunique().reset_index()
-        unique_products_purchased.rename(columns={'StockCode': 'Unique_Products_Purchased'}, inplace=True)
 
-        # Merge the new feature into the customer_data dataframe
-        self.customer_data = pd.merge(self.customer_data, unique_products_purchased, on='CustomerID')
+def write_frame_npz(df, path):
+    # Store every column as a NumPy array; string and categorical columns are stored as integer codes plus their unique values
+    arrays = {'__columns__': np.array(df.columns, dtype=str), '__dtypes__': np.array([str(dtype) for dtype in df.dtypes], dtype=str)}
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            arrays['codes_{}'.format(i)] = values.cat.codes.to_numpy()
+            arrays['values_{}'.format(i)] = np.array(values.cat.categories, dtype=str)
+        elif values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            codes, uniques = pd.factorize(values)
+            arrays['codes_{}'.format(i)] = codes
+            arrays['values_{}'.format(i)] = np.array(uniques, dtype=str)
+        else:
+            arrays['data_{}'.format(i)] = values.to_numpy()
+
+    with atomic_output(path) as temporary_path:
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, **arrays)
 
-        # Extract day of week and hour from InvoiceDate
-        self.df['Day_Of_Week'] = self.df['InvoiceDate'].dt.dayofweek
-        self.df['Hour'] = self.df['InvoiceDate'].dt.hour
 
-        # Calculate the average number of days between consecutive purchases
-        # days_between_purchases = self.df.groupby('CustomerID')['InvoiceDay'].apply(lambda x: (x.diff().dropna()).apply(lambda y: y.days))
-        days_between_purchases = (
-            self.df.groupby('CustomerID')['InvoiceDay']
-            .apply(lambda x: x.diff().dropna().apply(lambda y: y.days) if not x.empty else pd.Series(dtype="float64"))
-        )
+def read_frame_npz(path):
+    with np.load(path, allow_pickle=False) as bundle:
+        columns = {}
+        for i, (column, dtype) in enumerate(zip(bundle['__columns__'], bundle['__dtypes__'])):
+            if 'data_{}'.format(i) in bundle:
+                columns[column] = bundle['data_{}'.format(i)]
+            elif dtype == 'category':
+                columns[column] = pd.Categorical.from_codes(bundle['codes_{}'.format(i)], bundle['values_{}'.format(i)])
+            else:
+                codes = bundle['codes_{}'.format(i)]
+                values = bundle['values_{}'.format(i)].astype(object)[codes]
+                values[codes == -1] = np.nan
+                columns[column] = pd.Series(values).astype(dtype)
+    return pd.DataFrame(columns)
 
-        average_days_between_purchases = days_between_purchases.groupby('CustomerID').mean().reset_index()
-        average_days_between_purchases.rename(columns={'InvoiceDay': 'Average_Days_Between_Purchases'}, inplace=True)
 
-        # Find the favorite shopping day of the week
-        favorite_shopping_day = self.df.groupby(['CustomerID', 'Day_Of_Week']).size().reset_index(name='Count')
-        favorite_shopping_day = favorite_shopping_day.loc[favorite_shopping_day.groupby('CustomerID')['Count'].idxmax()][['CustomerID', 'Day_Of_Week']]
+def cancelled_transactions(df):
+    # Boolean mask of cancelled rows, from the compact Is_Cancelled flag or the Transaction_Status strings
+    if 'Is_Cancelled' in df:
+        return df['Is_Cancelled'].to_numpy()
+    return (df['Transaction_Status'] == 'Cancelled').to_numpy()
 
-        # Find the favorite shopping hour of the day
-        favorite_shopping_hour = self.df.groupby(['CustomerID', 'Hour']).size().reset_index(name='Count')
-        favorite_shopping_hour = favorite_shopping_hour.loc[favorite_shopping_hour.groupby('CustomerID')['Count'].idxmax()][['CustomerID', 'Hour']]
 
-        # Merge the new features into the customer_data dataframe
-        self.customer_data = pd.merge(self.customer_data, average_days_between_purchases, on='CustomerID')
-        self.customer_data = pd.merge(self.customer_data, favorite_shopping_day, on='CustomerID')
-        self.customer_data = pd.merge(self.customer_data, favorite_shopping_hour, on='CustomerID')
+def downcast_customer_features(customer_data):
+    # Compact mode keeps the engineered features as int32 and float32; CustomerID stays float64 as written to the output
+    dtypes = {}
+    for column, dtype in customer_data.dtypes.items():
+        if column != 'CustomerID' and pd.api.types.is_integer_dtype(dtype):
+            dtypes[column] = 'int32'
+        elif column != 'CustomerID' and pd.api.types.is_float_dtype(dtype):
+            dtypes[column] = 'float32'
+    return customer_data.astype(dtypes)
 
-        # Group by CustomerID and Country to get the number of transactions per country for each customer
-        customer_country = self.df.groupby(['CustomerID', 'Country']).size().reset_index(name='Number_of_Transactions')
 
-        # Get the country with the maximum number of transactions for each customer (in case a customer has transactions from multiple countries)
-        customer_main_country = customer_country.sort_values('Number_of_Transactions', ascending=False).drop_duplicates('CustomerID')
+def memory_usage_bytes(value):
+    # In-memory size of a frame, index, array or sparse matrix held by the pipeline
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep=True))
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, 'indptr'):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return 0
 
-        # Create a binary column indicating whether the customer is from the UK or not
-        customer_main_country['Is_UK'] = customer_main_country['Country'].apply(lambda x: 1 if x == 'United Kingdom' else 0)
 
-        # Merge this data with our customer_data dataframe
-        self.customer_data = pd.merge(self.customer_data, customer_main_country[['CustomerID', 'Is_UK']], on='CustomerID', how='left')
+# Rows converted to text per to_csv call by the streaming CSV writers, which bounds the memory of the text buffer
+OUTPUT_CHUNK_ROWS = 100000
 
-        # Calculate the total number of transactions made by each customer
-        total_transactions = self.df.groupby('CustomerID')['InvoiceNo'].nunique().reset_index()
 
-        # Calculate the number of cancelled transactions for each customer
-        cancelled_transactions = self.df[self.df['Transaction_Status'] == 'Cancelled']
-        cancellation_frequency = cancelled_transactions.groupby('CustomerID')['InvoiceNo'].nunique().reset_index()
-        cancellation_frequency.rename(columns={'InvoiceNo': 'Cancellation_Frequency'}, inplace=True)
+def write_csv_stream(df, file, chunk_rows):
+    # Write the header with the first chunk, then append the remaining chunks
+    for start in range(0, max(len(df), 1), chunk_rows):
+        df.iloc[start:start + chunk_rows].to_csv(file, header=start == 0, index=False)
+
+
+def write_csv(df, path, chunk_rows=OUTPUT_CHUNK_ROWS):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        write_csv_stream(df, file, chunk_rows)
+
+
+def write_csv_gzip(df, path, chunk_rows=OUTPUT_CHUNK_ROWS):
+    import gzip
+
+    # A low compression level keeps most of the size reduction at a fraction of the default level's cost
+    with gzip.open(path, 'wt', newline='', encoding='utf-8', compresslevel=3) as file:
+        write_csv_stream(df, file, chunk_rows)
+
+
+def write_csv_zstd(df, path, chunk_rows=OUTPUT_CHUNK_ROWS):
+    import io
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Writing zstd-compressed CSV needs the zstandard package (pip install zstandard)')
+
+    with open(path, 'wb') as raw, zstandard.ZstdCompressor(level=3).stream_writer(raw) as compressed:
+        with io.TextIOWrapper(compressed, newline='', encoding='utf-8') as file:
+            write_csv_stream(df, file, chunk_rows)
+
+
+def write_npz(df, path, chunk_rows=OUTPUT_CHUNK_ROWS):
+    # Binary columnar output; string columns are stored once per distinct value, read it back with read_frame_npz
+    write_frame_npz(df, path)
+
+
+# Output writers by file extension
+OUTPUT_WRITERS = {
+    '.csv': write_csv,
+    '.csv.gz': write_csv_gzip,
+    '.csv.zst': write_csv_zstd,
+    '.npz': write_npz,
+}
+
+
+# Optional packages the writers (and pandas, to read the files back) need for an extension, checked before any stage runs
+OUTPUT_REQUIREMENTS = {
+    '.csv.zst': 'zstandard',
+}
+
+
+def output_writer(path):
+    import importlib.util
+
+    # Match the longest extension first, so output.csv.gz is gzip rather than plain CSV
+    for extension in sorted(OUTPUT_WRITERS, key=len, reverse=True):
+        if path.endswith(extension):
+            package = OUTPUT_REQUIREMENTS.get(extension)
+            if package and importlib.util.find_spec(package) is None:
+                raise ImportError('{} needs the {} package (pip install {})'.format(path, package, package))
+            return extension, OUTPUT_WRITERS[extension]
+    raise ValueError('No output writer for {}, expected one of {}'.format(path, ', '.join(OUTPUT_WRITERS)))
+
+
+def output_directory(path):
+    # The normalized and partitioned outputs are directories named after the wide file they replace without its extension:
+    # output.csv -> output/products.csv, ... or output/cluster=0.csv, ...
+    extension, _ = output_writer(path)
+    return path[:-len(extension)]
+
+
+def check_output_path(path, layout='wide', partition_by=None):
+    # Fail before the pipeline runs rather than after it, when the output would collide with an existing file or directory
+    extension, _ = output_writer(path)
+    if layout == 'wide' and partition_by is None:
+        if os.path.isdir(path):
+            raise ValueError('Output {} is an existing directory'.format(path))
+        return path
+    directory = output_directory(path)
+    if not os.path.basename(directory):
+        raise ValueError('Output {} has no name left for its directory once {} is removed'.format(path, extension))
+    if os.path.exists(directory) and not os.path.isdir(directory):
+        raise ValueError('Output directory {} is an existing file'.format(directory))
+    return directory
+
+
+def read_output_table(path):
+    # Read a table written by one of the OUTPUT_WRITERS back into a frame
+    if path.endswith('.npz'):
+        return read_frame_npz(path)
+    return pd.read_csv(path, dtype={'StockCode': str, 'Description': str})
+
+
+def find_recommendation_files(path):
+    # Guess the layout and files of an output written without a record of them (see generate_output_csv): the plain file
+    # at `path` wins over the directory named after it, which holds either normalized tables or partitions
+    extension, _ = output_writer(path)
+    if os.path.isfile(path):
+        return {'layout': 'wide', 'files': [path]}
+    directory = output_directory(path)
+    if not os.path.isdir(directory):
+        raise FileNotFoundError('No recommendation table at {} or {}'.format(path, directory))
+    names = sorted(name for name in os.listdir(directory) if name.endswith(extension))
+    if 'products' + extension in names:
+        return {'layout': 'normalized', 'files': [os.path.join(directory, name) for name in names if '=' not in name]}
+    if not names:
+        raise FileNotFoundError('No {} tables in {}'.format(extension, directory))
+    return {'layout': 'partitioned', 'files': [os.path.join(directory, name) for name in names if '=' in name]}
+
+
+def read_recommendation_table(path, written=None):
+    # Read an output of generate_output_csv back into the wide table. `written` is the layout and files it returned (kept
+    # in the ready marker of `recommend.py run`); without it they are guessed from what is on disk
+    extension, _ = output_writer(path)
+    written = written or find_recommendation_files(path)
+    if written['layout'] == 'wide':
+        return read_output_table(written['files'][0])
+    tables = {os.path.basename(file)[:-len(extension)]: read_output_table(file) for file in written['files']}
+    if written['layout'] == 'normalized':
+        return denormalize_recommendations(tables)
+    return pd.concat(tables.values(), ignore_index=True)
+
+
+def product_id_lookup(products, stock_codes, descriptions):
+    # Position of every (StockCode, Description) pair in the products table, -1 where there is no product
+    keys = pd.MultiIndex.from_arrays([products['StockCode'].astype(str), products['Description'].astype(str)])
+    missing = pd.isna(stock_codes)
+    product_ids = keys.get_indexer(pd.MultiIndex.from_arrays([pd.Series(stock_codes).astype(str), pd.Series(descriptions).astype(str)]))
+    return np.where(missing, -1, product_ids).astype(np.int32)
+
+
+def normalize_recommendations(wide, products, top_products, exceptions_only=False):
+    # Split the wide recommendation table into a product dimension, each cluster's ranked top products and a per-customer
+    # table holding product ids instead of repeated StockCode/Description strings. Customers keep only their id and cluster,
+    # the features are left to the wide layout and the pipeline's own customer data
+    n_recs = len(recommendation_numbers(wide.columns))
+    cluster_top_products = pd.DataFrame({'cluster': top_products['cluster'].to_numpy(), 'Rank': top_products['Rank'].to_numpy(),
+                                         'Product_ID': product_id_lookup(products, top_products['StockCode'], top_products['Description'])})
+    customers = wide[['CustomerID', 'cluster']]
+    recommended = pd.DataFrame({'CustomerID': wide['CustomerID'].to_numpy()})
+    for rec in range(1, n_recs + 1):
+        recommended['Rec{}_Product_ID'.format(rec)] = product_id_lookup(products, wide['Rec{}_StockCode'.format(rec)], wide['Rec{}_Description'.format(rec)])
+
+    # The product table holds every product referenced by a cluster's top list or by any customer's recommendations
+    recommended_ids = recommended.iloc[:, 1:].to_numpy().ravel()
+    used = np.union1d(cluster_top_products['Product_ID'].to_numpy(), recommended_ids[recommended_ids >= 0])
+    used = used[used >= 0]
+    product_table = pd.DataFrame({'Product_ID': used, 'StockCode': products['StockCode'].to_numpy()[used],
+                                  'Description': products['Description'].to_numpy()[used]})
+    tables = {'products': product_table, 'cluster_top_products': cluster_top_products}
+    if not exceptions_only:
+        tables['customers'] = customers.merge(recommended, on='CustomerID')
+        return tables
+
+    # Only keep the customers whose recommendations differ from their cluster's default, the first n_recs top products
+    defaults = cluster_default_recommendations(cluster_top_products, n_recs)
+    expected = defaults.reindex(wide['cluster'].to_numpy()).to_numpy()
+    exceptions = (recommended.iloc[:, 1:].to_numpy() != expected).any(axis=1)
+    tables['customers'] = customers
+    tables['recommendation_exceptions'] = recommended[exceptions].reset_index(drop=True)
+    return tables
+
+
+def cluster_default_recommendations(cluster_top_products, n_recs=3):
+    # Product ids of the first n_recs ranked products of every cluster, -1 where a cluster has fewer products
+    defaults = cluster_top_products[cluster_top_products['Rank'] < n_recs].pivot(index='cluster', columns='Rank', values='Product_ID')
+    defaults = defaults.reindex(columns=range(n_recs)).fillna(-1).astype(np.int32)
+    defaults.columns = ['Rec{}_Product_ID'.format(rec) for rec in range(1, n_recs + 1)]
+    return defaults
+
+
+def denormalize_recommendations(tables):
+    # Rebuild the CustomerID, cluster and Rec columns of the wide table of generate_output_csv from the normalized tables
+    customers = tables['customers']
+    n_recs = len(recommendation_numbers(tables.get('recommendation_exceptions', customers).columns, 'Product_ID'))
+    id_columns = ['Rec{}_Product_ID'.format(rec) for rec in range(1, n_recs + 1)]
+    if 'recommendation_exceptions' in tables:
+        # Start from the cluster defaults and overwrite the customers listed as exceptions
+        recommended = cluster_default_recommendations(tables['cluster_top_products'], n_recs).reindex(customers['cluster'].to_numpy()).to_numpy(copy=True)
+        exceptions = tables['recommendation_exceptions']
+        recommended[pd.Index(customers['CustomerID']).get_indexer(exceptions['CustomerID'])] = exceptions[id_columns].to_numpy()
+        customers = customers.assign(**{column: recommended[:, position] for position, column in enumerate(id_columns)})
+
+    products = tables['products'].set_index('Product_ID')
+    wide = customers.drop(columns=id_columns)
+    for rec, column in enumerate(id_columns, start=1):
+        ids = customers[column].to_numpy()
+        for attribute in ['StockCode', 'Description']:
+            values = products[attribute].reindex(ids).to_numpy(dtype=object)
+            values[ids < 0] = None
+            wide['Rec{}_{}'.format(rec, attribute)] = values
+    return wide
+
+
+# Per-customer features computed in the single fused groupby pass of feature_engineer: name -> (transaction column, aggregation)
+CUSTOMER_AGGREGATIONS = {
+    'Last_Purchase_Day': ('InvoiceDay', 'max'),
+    'Total_Transactions': ('InvoiceNo', 'nunique'),
+    'Total_Spend': ('Total_Spend', 'sum'),
+    'Average_Days_Between_Purchases': ('Days_Between_Purchases', 'mean'),
+    'Cancellation_Frequency': ('Cancelled_InvoiceNo', 'nunique'),
+}
+
+
+def kahan_group_sum(codes, values, sums, compensations):
+    # Continue pandas' Kahan-compensated groupby sum over new values in row order, updating sums and compensations in place,
+    # so a sum folded batch by batch is bit-for-bit identical to one groupby sum over all rows
+    order = np.argsort(codes, kind='stable')
+    codes, values = codes[order], values[order]
+    position = np.arange(len(codes)) - np.searchsorted(codes, codes)
+
+    # Every step adds the k-th new value of each group, so no group is updated twice within a step
+    by_position = np.argsort(position, kind='stable')
+    bounds = np.searchsorted(position[by_position], np.arange(position.max() + 2 if len(position) else 1))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        labels, value = codes[by_position[start:end]], values[by_position[start:end]]
+        y = value - compensations[labels]
+        t = sums[labels] + y
+        compensation = t - sums[labels] - y
+        # A NaN compensation means an infinite value was added; pandas resets it so the sum stays infinite
+        compensations[labels] = np.where(np.isnan(compensation), 0, compensation)
+        sums[labels] = t
+
+
+def grouped_mode(group_codes, values, n_groups, weights=None):
+    # Find the most frequent value of each group by counting flat group_code * K + value_code indexes with one bincount,
+    # where K is the number of distinct values; values are coded in sorted order so ties go to the smallest value
+    value_codes, uniques = pd.factorize(values, sort=True)
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    valid = value_codes >= 0
+    weights = None if weights is None else np.asarray(weights)[valid]
+    counts = np.bincount(group_codes[valid] * len(uniques) + value_codes[valid], weights=weights, minlength=n_groups * len(uniques))
+    return np.asarray(uniques)[counts.reshape(n_groups, len(uniques)).argmax(axis=1)]
+
+
+def monthly_spending_features(monthly_spending):
+    # Calculate Seasonal Buying Patterns: We are using monthly frequency as a proxy for seasonal buying patterns
+    seasonal_buying_patterns = monthly_spending.groupby('CustomerID')['Total_Spend'].agg(['mean', 'std']).reset_index()
+    seasonal_buying_patterns.rename(columns={'mean': 'Monthly_Spending_Mean', 'std': 'Monthly_Spending_Std'}, inplace=True)
+
+    # Replace NaN values in Monthly_Spending_Std with 0, implying no variability for customers with single transaction month
+    # seasonal_buying_patterns['Monthly_Spending_Std'].fillna(0, inplace=True)
+    seasonal_buying_patterns['Monthly_Spending_Std'] = seasonal_buying_patterns['Monthly_Spending_Std'].fillna(0)
+
+    # Calculate Trends in Spending 
+    # We are using the slope of the linear trend line fitted to the customer's spending over time as an indicator of spending trends.
+    # The least-squares slope over x = 0, 1, ..., n - 1 is computed for all customers at once from grouped sums:
+    # slope = sum((x - mean(x)) * y) / sum((x - mean(x)) ** 2), where sum((x - mean(x)) ** 2) = n * (n ** 2 - 1) / 12
+    grouped = monthly_spending.groupby('CustomerID')
+    x = grouped.cumcount().to_numpy()
+    n = grouped['Total_Spend'].transform('size').to_numpy()
+    centered_products = pd.Series((x - (n - 1) / 2) * monthly_spending['Total_Spend'].to_numpy()).groupby(monthly_spending['CustomerID'].to_numpy()).sum()
+    months = grouped.size()
+    spending_trends = centered_products.to_numpy() / (months * (months ** 2 - 1) / 12)
+
+    # If there is only one data point, no trend can be calculated, hence the slope is 0
+    spending_trends = spending_trends.where(months > 1, 0).rename('Spending_Trend').reset_index()
+
+    return pd.merge(seasonal_buying_patterns, spending_trends, on='CustomerID')
+
+
+def shard_customer_features(transactions, most_recent_date):
+    # Compute the features of one shard of customers in a worker process, with its own interaction index
+    rec_system = RecommendationSystem(None)
+    rec_system.df = transactions
+    rec_system.build_interaction_index()
+    return rec_system.customer_features(most_recent_date)
+
+
+# Data shared with the k-selection worker processes, set once per worker by the pool initializer
+k_selection_data = {}
+
+
+def init_k_selection_worker(components, sample):
+    k_selection_data['components'], k_selection_data['sample'] = components, sample
+
+
+def score_candidate_k(k):
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, silhouette_score
+    from threadpoolctl import threadpool_limits
+
+    components, sample = k_selection_data['components'], k_selection_data['sample']
+
+    # One BLAS/OpenMP thread per worker, the pool already runs one candidate per core
+    with threadpool_limits(limits=1):
+        start = time.perf_counter()
+        labels = KMeans(n_clusters=k, init='k-means++', n_init=10, max_iter=100, random_state=0).fit(components)
+        seconds = time.perf_counter() - start
 
-        # Merge the Cancellation Frequency data into the customer_data dataframe
-        self.customer_data = pd.merge(self.customer_data, cancellation_frequency, on='CustomerID', how='left')
+        # Silhouette is O(n^2) so it is computed on the bounded sample, CH and DB are linear and use every customer
+        return {'k': k, 'Inertia': labels.inertia_, 'Silhouette': silhouette_score(components[sample], labels.labels_[sample]),
+                'Calinski_Harabasz': calinski_harabasz_score(components, labels.labels_),
+                'Davies_Bouldin': davies_bouldin_score(components, labels.labels_), 'Seconds': seconds}
 
-        # Replace NaN values with 0 (for customers who have not cancelled any transaction)
-        self.customer_data['Cancellation_Frequency'].fillna(0, inplace=True)
 
-        # Calculate the Cancellation Rate
-        # self.customer_data['Cancellation_Rate'] = self.customer_data['Cancellation_Frequency'] / total_transactions['InvoiceNo']
-        self.customer_data['Cancellation_Frequency'] = self.customer_data['Cancellation_Frequency'].fillna(0)
+class RecommendationSystem:
+    def __init__(self, file_path, compact=False):
+        self.file_path = file_path
+        self.compact = compact
+        self.clean_cache_path = None
+        self.df = None
+        self.cleaning_report = None
+        self.customer_data = None
+        self.customer_data_cleaned = None
+        self.customer_data_scaled = None
+        self.customer_data_pca = None
+        self.outliers_data = None
+        self.customer_data_with_recommendations = None
+        self.outlier_model = None
+        self.scaler = None
+        self.scaled_columns = None
+        self.pca = None
+        self.optimal_k = None
+        self.k_selection = None
+        self.kmeans = None
+        self.label_mapping = None
+        self.top_products = None
+        self.recommendation_engine = None
+        self.customer_ids = None
+        self.products = None
+        self.product_stock_codes = None
+        self.stock_codes = None
+        self.interactions = None
+
+    def load_data(self, chunksize=None):
+        # Read only the schema columns with explicit dtypes and a fixed InvoiceDate format
+        dtypes = COMPACT_TRANSACTION_DTYPES if self.compact else TRANSACTION_DTYPES
+        reader = pd.read_csv(self.file_path, encoding="ISO-8859-1", usecols=list(dtypes) + ['InvoiceDate'],
+                             dtype=dtypes, parse_dates=['InvoiceDate'], date_format=INVOICE_DATE_FORMAT,
+                             chunksize=chunksize)
+        if chunksize is None:
+            self.df = reader
+            return
+
+        # Read the file in bounded-size chunks and give every chunk the same categories so they concatenate as categoricals
+        chunks = list(reader)
+        for column, dtype in dtypes.items():
+            if dtype == 'category':
+                categories = union_categoricals([chunk[column] for chunk in chunks], sort_categories=True).categories
+                for chunk in chunks:
+                    chunk[column] = chunk[column].cat.set_categories(categories)
+        self.df = pd.concat(chunks, ignore_index=True)
+
+
+    def load_clean_data(self, cache_dir='.cache', chunksize=None):
+        # Key the cache on the input file's size and modification time plus the cleaning-rule version and the representation
+        stat = os.stat(self.file_path)
+        key = '{}:{}:{}:{}'.format(os.path.abspath(self.file_path), stat.st_size, stat.st_mtime_ns, CLEANING_VERSION)
+        if self.compact:
+            key += ':compact'
+        cache_path = os.path.join(cache_dir, 'clean_{}.npz'.format(hashlib.sha256(key.encode()).hexdigest()[:16]))
+        self.clean_cache_path = cache_path
+
+        # Load the cleaned transaction table directly when the input has not changed since it was cached
+        if os.path.exists(cache_path):
+            self.df = read_frame_npz(cache_path)
+            return
+
+        # Otherwise parse and clean the CSV, then cache the result for the next run
+        self.load_data(chunksize=chunksize)
+        self.clean_data()
+        os.makedirs(cache_dir, exist_ok=True)
+        write_frame_npz(self.df, cache_path)
 
-        # Extract month and year from InvoiceDate
-        self.df['Year'] = self.df['InvoiceDate'].dt.year
-        self.df['Month'] = self.df['InvoiceDate'].dt.month
 
-        # Calculate monthly spending for each customer
-        monthly_spending = self.df.groupby(['CustomerID', 'Year', 'Month'])['Total_Spend'].sum().reset_index()
+    def clean_data(self):
+        # Evaluate every rule in CLEANING_RULES into one combined mask, counting the rows each rule removes on top of the earlier ones
+        removed = np.zeros(len(self.df), dtype=bool)
+        report = []
+        for name, rule in CLEANING_RULES:
+            start = time.perf_counter()
+            rule_removes = np.asarray(rule(self.df), dtype=bool)
+            report.append({'Rule': name, 'Rows_Removed': int((rule_removes & ~removed).sum()), 'Seconds': time.perf_counter() - start})
+            removed |= rule_removes
+
+        # Filter the frame once and reset the index of the cleaned dataset
+        self.df = self.df[~removed].reset_index(drop=True)
+
+        # Create a new column indicating the transaction status; invoices starting with "C" are cancellations
+        # (a boolean flag in compact mode, since the status strings would be repeated on every row)
+        start = time.perf_counter()
+        cancelled = self.df['InvoiceNo'].astype(str).str.startswith('C').to_numpy(dtype=bool)
+        if self.compact:
+            self.df['Is_Cancelled'] = cancelled
+        else:
+            self.df['Transaction_Status'] = np.where(cancelled, 'Cancelled', 'Completed')
+        report.append({'Rule': 'transaction_status', 'Rows_Removed': 0, 'Seconds': time.perf_counter() - start})
+
+        # Standardize the text to uppercase to maintain uniformity across the dataset, upper-casing each distinct description once
+        start = time.perf_counter()
+        codes, descriptions = factorize_column(self.df['Description'])
+        descriptions, upper_codes = np.unique(np.asarray(descriptions.str.upper(), dtype=str), return_inverse=True)
+        self.df['Description'] = pd.Categorical.from_codes(np.where(codes >= 0, upper_codes[codes], -1), descriptions)
+        report.append({'Rule': 'uppercase_descriptions', 'Rows_Removed': 0, 'Seconds': time.perf_counter() - start})
+
+        self.cleaning_report = pd.DataFrame(report)
+        print(self.cleaning_report.to_string(index=False))
+
+
+    def build_interaction_index(self):
+        from scipy import sparse
+
+        # Encode each transaction's CustomerID and (StockCode, Description) product as integer codes in sorted order
+        customer_codes, self.customer_ids = pd.factorize(self.df['CustomerID'], sort=True)
+        self.df['Customer_Code'] = customer_codes.astype(np.int32)
+        products = self.df.groupby(['StockCode', 'Description'], observed=True)
+        product_codes = products.ngroup().to_numpy()
+        self.df['Product_Code'] = product_codes.astype(np.int32)
+        self.products = products.size().reset_index()[['StockCode', 'Description']]
+
+        # Map every product to its StockCode, since a stock code can appear under several descriptions
+        self.product_stock_codes, self.stock_codes = pd.factorize(self.products['StockCode'], sort=True)
+
+        # Build the customer x product matrix of quantities; duplicate entries are summed and net-zero
+        # entries are kept as explicit zeros so the sparsity pattern still records every purchase
+        self.interactions = sparse.csr_matrix((self.df['Quantity'].to_numpy(), (customer_codes, product_codes)),
+                                              shape=(len(self.customer_ids), len(self.products)))
+
+
+    def _interaction_presence(self):
+        # Customer x product matrix with a 1 for every product the customer has a transaction for
+        presence = self.interactions.copy()
+        presence.data = np.ones(presence.nnz, dtype=np.int32)
+        return presence
+
+
+    def _purchased_stock_codes(self):
+        from scipy import sparse
+
+        # Collapse the product columns onto their stock codes to get a customer x StockCode presence matrix
+        n_products = len(self.products)
+        product_to_stock = sparse.csr_matrix((np.ones(n_products, dtype=np.int32), (np.arange(n_products), self.product_stock_codes)),
+                                             shape=(n_products, len(self.stock_codes)))
+        return self._interaction_presence() @ product_to_stock
+
+
+    def feature_engineer(self, n_jobs=None, n_shards=None):
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Build the interaction index if it has not been built after clean_data
+        if self.interactions is None:
+            self.build_interaction_index()
+
+        # Add the per-transaction columns
+        self.add_transaction_columns()
 
-        # Calculate Seasonal Buying Patterns: We are using monthly frequency as a proxy for seasonal buying patterns
-        seasonal_buying_patterns = monthly_spending.groupby('CustomerID')['Total_Spend'].agg(['mean', 'std']).reset_index()
-        seasonal_buying_patterns.rename(columns={'mean': 'Monthly_Spending_Mean', 'std': 'Monthly_Spending_Std'}, inplace=True)
-
-        # Replace NaN values in Monthly_Spending_Std with 0, implying no variability for customers with single transaction month
-        # seasonal_buying_patterns['Monthly_Spending_Std'].fillna(0, inplace=True)
-        seasonal_buying_patterns['Monthly_Spending_Std'] = seasonal_buying_patterns['Monthly_Spending_Std'].fillna(0)
-
-        # Calculate Trends in Spending 
-        # We are using the slope of the linear trend line fitted to the customer's spending over time as an indicator of spending trends
-        def calculate_trend(spend_data):
-            # If there are more than one data points, we calculate the trend using linear regression
-            if len(spend_data) > 1:
-                x = np.arange(len(spend_data))
-                slope, _, _, _, _ = linregress(x, spend_data)
-                return slope
-            # If there is only one data point, no trend can be calculated, hence we return 0
-            else:
-                return 0
+        # Find the most recent date in the entire dataset
+        most_recent_date = self.df['InvoiceDay'].max()
 
-        # Apply the calculate_trend function to find the spending trend for each customer
-        spending_trends = monthly_spending.groupby('CustomerID')['Total_Spend'].apply(calculate_trend).reset_index()
-        spending_trends.rename(columns={'Total_Spend': 'Spending_Trend'}, inplace=True)
+        if n_jobs is None or n_jobs <= 1:
+            customer_data = self.customer_features(most_recent_date)
+        else:
+            # Every feature but the recency date is per customer, so hash-partition the transactions by CustomerID
+            # (keeping the row order within each shard), compute each shard's features in a worker process with the
+            # global recency date broadcast to it, and put the customers back in CustomerID order
+            n_shards = n_shards or n_jobs
+            shard_ids = pd.util.hash_array(self.df['CustomerID'].to_numpy()) % n_shards
+            shards = [self.df[shard_ids == shard] for shard in range(n_shards)]
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(shard_customer_features, [shard for shard in shards if len(shard)],
+                                        [most_recent_date] * n_shards))
+            customer_data = pd.concat(results).sort_values('CustomerID', kind='stable')
+
+        # Customers with a single transaction row have no gaps between purchases and are left out
+        self.customer_data = customer_data[customer_data['Average_Days_Between_Purchases'].notna()].reset_index(drop=True)
+        if self.compact:
+            self.customer_data = downcast_customer_features(self.customer_data)
+
+
+    def add_transaction_columns(self):
+        # Convert InvoiceDate to datetime type
+        self.df['InvoiceDate'] = pd.to_datetime(self.df['InvoiceDate'])
 
-        # Merge the new features into the customer_data dataframe
-        self.customer_data = pd.merge(self.customer_data, seasonal_buying_patterns, on='CustomerID')
-        self.customer_data = pd.merge(self.customer_data, spending_trends, on='CustomerID')
+        # Convert InvoiceDate to datetime and extract only the date (as datetime64 days rather than Python date objects)
+        self.df['InvoiceDay'] = self.df['InvoiceDate'].dt.normalize()
 
+        # Calculate the spend of each transaction and extract day of week, hour, month and year from InvoiceDate
+        self.df['Total_Spend'] = self.df['UnitPrice'] * self.df['Quantity']
+        self.df['Day_Of_Week'] = self.df['InvoiceDate'].dt.dayofweek
+        self.df['Hour'] = self.df['InvoiceDate'].dt.hour
+        self.df['Year'] = self.df['InvoiceDate'].dt.year
+        self.df['Month'] = self.df['InvoiceDate'].dt.month
+        if self.compact:
+            self.df = self.df.astype(COMPACT_CALENDAR_DTYPES)
+
+
+    def customer_features(self, most_recent_date):
+        # Add the per-row inputs of the fused pass: the gap in days to the customer's previous row (in row order)
+        # and the invoice number of cancelled transactions only
+        transactions = self.df[['Customer_Code', 'InvoiceDay', 'InvoiceNo', 'Total_Spend']].assign(
+            Days_Between_Purchases=self.df.groupby('Customer_Code')['InvoiceDay'].diff().dt.days,
+            Cancelled_InvoiceNo=self.df['InvoiceNo'].where(cancelled_transactions(self.df)))
+
+        # Compute every aggregation in CUSTOMER_AGGREGATIONS in a single groupby pass over the integer customer codes
+        aggregates = transactions.groupby('Customer_Code').agg(**CUSTOMER_AGGREGATIONS)
+
+        # Assemble the features into one frame aligned on the customer codes
+        customer_data = pd.DataFrame({'CustomerID': self.customer_ids.to_numpy()}, index=pd.RangeIndex(len(self.customer_ids)))
+        customer_data['Days_Since_Last_Purchase'] = (most_recent_date - aggregates['Last_Purchase_Day']).dt.days
+        customer_data['Total_Transactions'] = aggregates['Total_Transactions']
+        customer_data['Total_Products_Purchased'] = np.asarray(self.interactions.sum(axis=1)).ravel()
+        customer_data['Total_Spend'] = aggregates['Total_Spend']
+        customer_data['Average_Transaction_Value'] = aggregates['Total_Spend'] / aggregates['Total_Transactions']
+        customer_data['Unique_Products_Purchased'] = np.diff(self._purchased_stock_codes().indptr).astype(np.int64)
+        customer_data['Average_Days_Between_Purchases'] = aggregates['Average_Days_Between_Purchases']
+
+        # Find the favorite shopping day of the week and hour of the day
+        customer_codes = self.df['Customer_Code'].to_numpy()
+        customer_data['Day_Of_Week'] = grouped_mode(customer_codes, self.df['Day_Of_Week'], len(self.customer_ids))
+        customer_data['Hour'] = grouped_mode(customer_codes, self.df['Hour'], len(self.customer_ids))
+
+        # Flag the customers whose main country (the one with the most transactions) is the UK
+        main_country = grouped_mode(customer_codes, self.df['Country'], len(self.customer_ids))
+        customer_data['Is_UK'] = (main_country == 'United Kingdom').astype(np.int64)
+
+        # Customers who have not cancelled any transaction have a Cancellation Frequency of 0
+        customer_data['Cancellation_Frequency'] = aggregates['Cancellation_Frequency'].astype('float64')
+
+        # Calculate monthly spending for each customer, then the seasonal buying patterns and spending trends from it
+        monthly_spending = self.df.groupby(['CustomerID', 'Year', 'Month'])['Total_Spend'].sum().reset_index()
+        monthly_features = monthly_spending_features(monthly_spending).set_index('CustomerID').reindex(self.customer_ids)
+        for column in monthly_features.columns:
+            customer_data[column] = monthly_features[column].to_numpy()
+
+        return customer_data
+
+
+    def feature_engineer_incremental(self, state_path=os.path.join('.cache', 'customer_state.pkl')):
+        # Load the per-customer aggregates of every previous batch, or start from an empty state
+        state = None
+        if os.path.exists(state_path):
+            with open(state_path, 'rb') as file:
+                state = pickle.load(file)
+
+        # The state records a fingerprint of every batch folded into it; folding the same transactions twice would count them twice
+        fingerprint = hashlib.sha256(pd.util.hash_pandas_object(self.df, index=False).to_numpy().tobytes()).hexdigest()
+        if state is not None and fingerprint in state.get('batches', []):
+            raise ValueError('This batch of transactions was already folded into {}'.format(state_path))
+
+        # Fold the new batch of cleaned transactions in self.df into the aggregates and persist them
+        state = self.update_customer_state(state)
+        state['batches'] = state.get('batches', []) + [fingerprint]
+        os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+        write_pickle(state, state_path)
+
+        # Derive the same customer features as feature_engineer would over the full history
+        self.customer_data = self.customer_features_from_state(state)
+        if self.compact:
+            self.customer_data = downcast_customer_features(self.customer_data)
+
+
+    def update_customer_state(self, state=None):
+        # Derive the per-row columns feature_engineer works from for the new batch only
+        self.add_transaction_columns()
+        batch = self.df
+
+        # Start from empty tables on the first batch
+        if state is None:
+            state = {
+                'most_recent_date': batch['InvoiceDay'].max(),
+                'customers': pd.DataFrame({'CustomerID': pd.Series(dtype='float64'), 'Last_Day': pd.Series(dtype=batch['InvoiceDay'].dtype),
+                                           'First_Day': pd.Series(dtype=batch['InvoiceDay'].dtype), 'Final_Day': pd.Series(dtype=batch['InvoiceDay'].dtype),
+                                           'Rows': pd.Series(dtype='int64'), 'Total_Products_Purchased': pd.Series(dtype='int64'),
+                                           'Total_Spend': pd.Series(dtype='float64'), 'Compensation': pd.Series(dtype='float64')}),
+                'monthly': pd.DataFrame({'CustomerID': pd.Series(dtype='float64'), 'Year': pd.Series(dtype='int32'), 'Month': pd.Series(dtype='int32'),
+                                         'Total_Spend': pd.Series(dtype='float64'), 'Compensation': pd.Series(dtype='float64')}),
+            }
+        state = dict(state)
+        state['most_recent_date'] = max(state['most_recent_date'], batch['InvoiceDay'].max())
+
+        # Last purchase day, first and final day in row order, row count and quantity sums per customer
+        grouped = batch.groupby('CustomerID')
+        update = pd.DataFrame({'Last_Day': grouped['InvoiceDay'].max(), 'First_Day': grouped['InvoiceDay'].first(), 'Final_Day': grouped['InvoiceDay'].last(),
+                               'Rows': grouped.size(), 'Total_Products_Purchased': grouped['Quantity'].sum().astype(np.int64)})
+        previous = state['customers'].set_index('CustomerID')
+        index = previous.index.union(update.index)
+        previous, update = previous.reindex(index), update.reindex(index)
+        customers = pd.DataFrame({'Last_Day': pd.concat([previous['Last_Day'], update['Last_Day']], axis=1).max(axis=1),
+                                  'First_Day': previous['First_Day'].fillna(update['First_Day']),
+                                  'Final_Day': update['Final_Day'].fillna(previous['Final_Day']),
+                                  'Rows': previous['Rows'].fillna(0).add(update['Rows'].fillna(0)).astype(np.int64),
+                                  'Total_Products_Purchased': previous['Total_Products_Purchased'].fillna(0).add(update['Total_Products_Purchased'].fillna(0)).astype(np.int64)},
+                                 index=index)
+
+        # Continue the compensated spend sums so they match a groupby sum over all batches
+        sums, compensations = previous['Total_Spend'].fillna(0).to_numpy(copy=True), previous['Compensation'].fillna(0).to_numpy(copy=True)
+        kahan_group_sum(customers.index.get_indexer(batch['CustomerID']), batch['Total_Spend'].to_numpy(), sums, compensations)
+        customers['Total_Spend'], customers['Compensation'] = sums, compensations
+        state['customers'] = customers.reset_index(names='CustomerID')
+
+        # Distinct invoices and stock codes per customer
+        for name, column in [('invoices', 'InvoiceNo'), ('products', 'StockCode')]:
+            pairs = batch[['CustomerID', column]].astype({column: str})
+            state[name] = pd.concat([state[name], pairs]).drop_duplicates(ignore_index=True) if name in state else pairs.drop_duplicates(ignore_index=True)
+
+        # Day of week, hour and country histograms per customer
+        for name, column, count in [('days', 'Day_Of_Week', 'Count'), ('hours', 'Hour', 'Count'), ('countries', 'Country', 'Number_of_Transactions')]:
+            key = batch[column].astype(str) if column == 'Country' else batch[column]
+            counts = batch.groupby(['CustomerID', key]).size().reset_index(name=count)
+            state[name] = pd.concat([state[name], counts]).groupby(['CustomerID', column])[count].sum().reset_index() if name in state else counts
+
+        # Monthly spend buckets, again continuing the compensated sums
+        monthly = state['monthly'].set_index(['CustomerID', 'Year', 'Month'])
+        keys = pd.MultiIndex.from_frame(batch[['CustomerID', 'Year', 'Month']])
+        monthly = monthly.reindex(monthly.index.append(keys.unique().difference(monthly.index))).sort_index().fillna(0)
+        sums, compensations = monthly['Total_Spend'].to_numpy().copy(), monthly['Compensation'].to_numpy().copy()
+        kahan_group_sum(monthly.index.get_indexer(keys), batch['Total_Spend'].to_numpy(), sums, compensations)
+        monthly['Total_Spend'], monthly['Compensation'] = sums, compensations
+        state['monthly'] = monthly.reset_index()
+        return state
+
+
+    def customer_features_from_state(self, state):
+        customers = state['customers']
+        customer_data = pd.DataFrame({'CustomerID': customers['CustomerID'],
+                                      'Days_Since_Last_Purchase': (state['most_recent_date'] - customers['Last_Day']).dt.days})
+
+        # Invoice counts, totals and average transaction value
+        total_transactions = state['invoices'].groupby('CustomerID').size()
+        customer_data['Total_Transactions'] = total_transactions.reindex(customers['CustomerID']).to_numpy()
+        customer_data['Total_Products_Purchased'] = customers['Total_Products_Purchased']
+        customer_data['Total_Spend'] = customers['Total_Spend']
+        customer_data['Average_Transaction_Value'] = customer_data['Total_Spend'] / customer_data['Total_Transactions']
+        customer_data['Unique_Products_Purchased'] = state['products'].groupby('CustomerID').size().reindex(customers['CustomerID']).to_numpy()
+
+        # The mean gap between consecutive rows telescopes to (final day - first day) / (rows - 1);
+        # customers with a single row have no gaps and are dropped, as in feature_engineer
+        customer_data['Average_Days_Between_Purchases'] = (customers['Final_Day'] - customers['First_Day']).dt.days / (customers['Rows'] - 1)
+
+        # Favorite day, hour and main country from the histograms, using their counts as bincount weights
+        customer_ids = customers['CustomerID'].to_numpy()
+        for name, column, count in [('days', 'Day_Of_Week', 'Count'), ('hours', 'Hour', 'Count'), ('countries', 'Country', 'Number_of_Transactions')]:
+            histogram = state[name]
+            mode = grouped_mode(np.searchsorted(customer_ids, histogram['CustomerID']), histogram[column], len(customer_ids), weights=histogram[count])
+            customer_data[column] = mode
+        customer_data['Is_UK'] = (customer_data.pop('Country') == 'United Kingdom').astype(np.int64)
+        customer_data = customer_data[customers['Rows'] > 1]
+
+        # Cancelled invoices are the ones whose number starts with "C"
+        invoices = state['invoices']
+        cancellation_frequency = invoices[invoices['InvoiceNo'].str.startswith('C')].groupby('CustomerID').size().rename('Cancellation_Frequency').reset_index()
+        customer_data = pd.merge(customer_data, cancellation_frequency, on='CustomerID', how='left')
+        customer_data['Cancellation_Frequency'] = customer_data['Cancellation_Frequency'].fillna(0).astype('float64')
+
+        # Seasonal buying patterns and spending trends from the monthly buckets
+        customer_data = pd.merge(customer_data, monthly_spending_features(state['monthly'][['CustomerID', 'Year', 'Month', 'Total_Spend']]), on='CustomerID')
+        return customer_data.reset_index(drop=True)
+
+
+    def fix_outlier(self, contamination=0.05, n_jobs=None, max_samples='auto', sample_size=None, bundle_path=None):
+        from joblib import parallel_config
+        from sklearn.ensemble import IsolationForest
 
-    def fix_outlier(self):
         customer_data = self.customer_data
-        # Initializing the IsolationForest model with a contamination parameter of 0.05
-        model = IsolationForest(contamination=0.05, random_state=0)
+        feature_columns = list(customer_data.columns[1:])
+        features = customer_data.iloc[:, 1:].to_numpy()
+
+        if bundle_path:
+            # Score against the forest and threshold of a saved model bundle instead of refitting
+            bundle = ModelBundle.load(bundle_path).bundle
+            if bundle['feature_columns'] != feature_columns:
+                raise ValueError('Model bundle {} was fitted on different features'.format(bundle_path))
+            model = bundle['outlier_model']
+        else:
+            # Initializing the IsolationForest model with a contamination parameter of 0.05 by default, building the trees on n_jobs cores
+            model = IsolationForest(contamination=contamination, max_samples=max_samples, n_jobs=n_jobs, random_state=0)
+
+            # Fitting the model on our dataset (converting DataFrame to NumPy to avoid warning), or on a random subsample of customers
+            if sample_size is not None and sample_size < len(features):
+                model.fit(features[np.sort(np.random.RandomState(0).choice(len(features), sample_size, replace=False))])
+            else:
+                model.fit(features)
 
-        # Fitting the model on our dataset (converting DataFrame to NumPy to avoid warning)
-        customer_data['Outlier_Scores'] = model.fit_predict(customer_data.iloc[:, 1:].to_numpy())
+        # Scoring every customer, spread over n_jobs threads
+        with parallel_config(backend='threading', n_jobs=n_jobs):
+            customer_data['Outlier_Scores'] = model.predict(features)
 
         # Creating a new column to identify outliers (1 for inliers and -1 for outliers)
-        customer_data['Is_Outlier'] = [1 if x == -1 else 0 for x in customer_data['Outlier_Scores']]
+        customer_data['Is_Outlier'] = (customer_data['Outlier_Scores'] == -1).astype(int)
 
         # Separate the outliers for analysis
         outliers_data = customer_data[customer_data['Is_Outlier'] == 1]
@@ -235,9 +872,12 @@ class RecommendationSystem:
         customer_data_cleaned.reset_index(drop=True, inplace=True)
 
         self.customer_data_cleaned, self.outliers_data = customer_data_cleaned, outliers_data
+        self.outlier_model = model
 
 
     def feature_scale(self):
+        from sklearn.preprocessing import StandardScaler
+
         customer_data_cleaned = self.customer_data_cleaned
 
         # Initialize the StandardScaler
@@ -256,22 +896,66 @@ class RecommendationSystem:
         customer_data_scaled[columns_to_scale] = scaler.fit_transform(customer_data_scaled[columns_to_scale])
 
         self.customer_data_scaled = customer_data_scaled
+        self.scaler, self.scaled_columns = scaler, list(columns_to_scale)
+
 
+    def dimensionality_reduction(self, n_components=6, variance_threshold=None, method='full', batch_size=4096):
+        from sklearn.decomposition import PCA, IncrementalPCA
+        from sklearn.utils import gen_batches
 
-    def dimensionality_reduction(self):
         customer_data_scaled = self.customer_data_scaled
 
         # Setting CustomerID as the index column
         customer_data_scaled.set_index('CustomerID', inplace=True)
 
-        # Apply PCA
-        pca = PCA().fit(customer_data_scaled)
-
-        # Creating a PCA object with 6 components
-        pca = PCA(n_components=6)
-
-        # Fitting and transforming the original data to the new PCA dataframe
-        customer_data_pca = pca.fit_transform(customer_data_scaled)
+        # With a variance threshold n_components is only the upper bound (None keeps every component)
+        start = time.perf_counter()
+        if method == 'incremental':
+            # Fit and transform chunk by chunk so only one batch of the scaled matrix is worked on at a time;
+            # the last batch is merged into the previous one when it has fewer rows than components
+            pca = IncrementalPCA(n_components=n_components)
+            min_batch_size = n_components or customer_data_scaled.shape[1]
+            batches = list(gen_batches(len(customer_data_scaled), batch_size, min_batch_size=min_batch_size))
+            for batch in batches:
+                pca.partial_fit(customer_data_scaled.iloc[batch])
+
+            # IncrementalPCA cannot pick its component count from a variance share and refitting would mean another pass
+            # over every batch, so the fitted model is truncated to the fewest components that explain the share. Only the
+            # fitted attributes change: the dropped components' variance moves into noise_variance_, and n_components keeps
+            # the requested upper bound, so the truncated model transforms but must not be partial_fit again
+            if variance_threshold is not None:
+                n_kept = min(int(np.searchsorted(np.cumsum(pca.explained_variance_ratio_), variance_threshold)) + 1, pca.n_components_)
+                n_features = customer_data_scaled.shape[1]
+                if n_kept < n_features:
+                    dropped_variance = pca.explained_variance_[n_kept:].sum() + pca.noise_variance_ * (n_features - pca.n_components_)
+                    pca.noise_variance_ = dropped_variance / (n_features - n_kept)
+                for attribute in ['components_', 'explained_variance_', 'explained_variance_ratio_', 'singular_values_']:
+                    setattr(pca, attribute, getattr(pca, attribute)[:n_kept])
+                pca.n_components_ = n_kept
+        elif variance_threshold is not None and method == 'full' and variance_threshold < 1:
+            # The exact solver picks the fewest components that explain the share itself; n_components still caps the count
+            pca = PCA(n_components=variance_threshold, svd_solver='full').fit(customer_data_scaled)
+            if n_components is not None and pca.n_components_ > n_components:
+                pca = PCA(n_components=n_components, svd_solver='full').fit(customer_data_scaled)
+        else:
+            # Fit PCA once, with the exact or the randomized SVD solver (much faster for wide data and few components)
+            pca = PCA(n_components=n_components, svd_solver='randomized' if method == 'randomized' else 'auto', random_state=0)
+            pca.fit(customer_data_scaled)
+
+            # The randomized solver only takes a component count, so find the fewest components that explain the share
+            # and refit with that count, which keeps every fitted attribute (noise_variance_ included) consistent
+            if variance_threshold is not None:
+                n_kept = min(int(np.searchsorted(np.cumsum(pca.explained_variance_ratio_), variance_threshold)) + 1, pca.n_components_)
+                if n_kept < pca.n_components_:
+                    pca = PCA(n_components=n_kept, svd_solver=pca.svd_solver, random_state=0).fit(customer_data_scaled)
+
+        # Transforming the original data to the new PCA dataframe
+        if method == 'incremental':
+            customer_data_pca = np.concatenate([pca.transform(customer_data_scaled.iloc[batch]) for batch in batches])
+        else:
+            customer_data_pca = pca.transform(customer_data_scaled)
+        print('PCA ({}): {} components explain {:.2%} of the variance, fitted in {:.2f}s'.format(
+            method, pca.n_components_, pca.explained_variance_ratio_.sum(), time.perf_counter() - start))
 
         # Creating a new dataframe from the PCA dataframe, with columns labeled PC1, PC2, etc.
         customer_data_pca = pd.DataFrame(customer_data_pca, columns=['PC'+str(i+1) for i in range(pca.n_components_)])
@@ -280,27 +964,62 @@ class RecommendationSystem:
         customer_data_pca.index = customer_data_scaled.index
 
         self.customer_data_pca = customer_data_pca
+        self.pca = pca
+
+    def select_k(self, candidates=None, sample_size=10000, n_jobs=None):
+        from concurrent.futures import ProcessPoolExecutor
+        from tabulate import tabulate
+
+        # Nothing to select when the number of clusters is fixed
+        self.optimal_k, self.k_selection = None, None
+        if not candidates:
+            return
+
+        # Fit every candidate k in its own process; the PCA matrix and silhouette sample are shipped once per worker
+        components = self.customer_data_pca.to_numpy(dtype=np.float64)
+        sample = np.sort(np.random.RandomState(0).permutation(len(components))[:sample_size])
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_k_selection_worker, initargs=(components, sample)) as pool:
+            k_selection = pd.DataFrame(list(pool.map(score_candidate_k, sorted(set(candidates)))))
+
+        # Pick the k with the best silhouette, using CH and DB as tie-breakers
+        best = k_selection.sort_values(['Silhouette', 'Calinski_Harabasz', 'Davies_Bouldin'], ascending=[False, False, True]).iloc[0]
+        self.optimal_k, self.k_selection = int(best['k']), k_selection
+        print(tabulate(k_selection, headers='keys', tablefmt='psql', showindex=False, floatfmt=['.0f'] + ['.4f'] * 5))
+        print('Selected k = {} (silhouette on a sample of {})'.format(self.optimal_k, len(sample)))
+
+
+    def kmeans_clustering(self, n_clusters=3, method='full', batch_size=4096, epochs=3, compare=False):
+        from sklearn.cluster import KMeans
 
-    def kmeans_clustering(self):
         customer_data_cleaned = self.customer_data_cleaned
         customer_data_pca =  self.customer_data_pca
 
-        # Apply KMeans clustering using the optimal k
-        kmeans = KMeans(n_clusters=3, init='k-means++', n_init=10, max_iter=100, random_state=0)
-        kmeans.fit(customer_data_pca)
+        # Use the k picked by select_k when the number of clusters is set to 'auto'
+        if n_clusters == 'auto':
+            n_clusters = self.optimal_k
+
+        if method == 'minibatch':
+            # Stream the PCA matrix in chunks through MiniBatchKMeans, whose cost per step does not grow with the customers
+            kmeans, labels = self._minibatch_kmeans(n_clusters, batch_size, epochs, compare)
+        else:
+            # Apply KMeans clustering using the optimal k
+            kmeans = KMeans(n_clusters=n_clusters, init='k-means++', n_init=10, max_iter=100, random_state=0)
+            kmeans.fit(customer_data_pca)
+            labels = kmeans.labels_
 
         # Get the frequency of each cluster
-        cluster_frequencies = Counter(kmeans.labels_)
+        cluster_frequencies = Counter(labels)
 
         # Create a mapping from old labels to new labels based on frequency
         label_mapping = {label: new_label for new_label, (label, _) in 
                         enumerate(cluster_frequencies.most_common())}
 
-        # Reverse the mapping to assign labels as per your criteria
-        label_mapping = {v: k for k, v in {2: 1, 1: 0, 0: 2}.items()}
+        # Reverse the mapping to assign labels as per your criteria (the fixed mapping only applies to full KMeans with 3 clusters)
+        if n_clusters == 3 and method != 'minibatch':
+            label_mapping = {v: k for k, v in {2: 1, 1: 0, 0: 2}.items()}
 
         # Apply the mapping to get the new labels
-        new_labels = np.array([label_mapping[label] for label in kmeans.labels_])
+        new_labels = np.array([label_mapping[label] for label in labels])
 
         # Append the new cluster labels back to the original dataset
         customer_data_cleaned['cluster'] = new_labels
@@ -309,77 +1028,523 @@ class RecommendationSystem:
         customer_data_pca['cluster'] = new_labels
 
         self.customer_data_cleaned, self.customer_data_pca = customer_data_cleaned, customer_data_pca
+        self.kmeans, self.label_mapping = kmeans, label_mapping
+
+
+    def _minibatch_kmeans(self, n_clusters, batch_size, epochs, compare):
+        from sklearn.cluster import KMeans, MiniBatchKMeans
+
+        # The PCA frame is already in memory (select_k, the clustering output and the checkpoints all use it), and at a few
+        # float columns per customer it is small, so the chunks are views of it rather than of a copy spilled to disk
+        components = self.customer_data_pca.to_numpy(dtype=np.float64)
+        chunks = [slice(start, start + batch_size) for start in range(0, len(components), batch_size)]
+
+        # Fit with partial_fit over the chunks for a few passes, then label and score chunk by chunk
+        start = time.perf_counter()
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, init='k-means++', batch_size=batch_size, random_state=0)
+        for _ in range(epochs):
+            for chunk in chunks:
+                kmeans.partial_fit(components[chunk])
+        labels = np.concatenate([kmeans.predict(components[chunk]) for chunk in chunks])
+        inertia = -sum(kmeans.score(components[chunk]) for chunk in chunks)
+        report = {'Method': ['minibatch'], 'Inertia': [inertia], 'Seconds': [time.perf_counter() - start]}
+
+        # Optionally fit full KMeans on the same data to compare the clustering quality
+        if compare:
+            start = time.perf_counter()
+            full = KMeans(n_clusters=n_clusters, init='k-means++', n_init=10, max_iter=100, random_state=0).fit(components)
+            report['Method'].append('full')
+            report['Inertia'].append(full.inertia_)
+            report['Seconds'].append(time.perf_counter() - start)
+        report = pd.DataFrame(report)
+        report['Inertia_Ratio'] = report['Inertia'] / report['Inertia'].min()
+        print(report.to_string(index=False))
+        return kmeans, labels
+
+
+    def recommendation_system(self, engine='cluster', n_recs=3, similarity='count', batch_size=2048):
+        from scipy import sparse
 
-
-    def recommendation_system(self):
         customer_data_cleaned = self.customer_data_cleaned 
-        outliers_data = self.outliers_data
-
-        # Step 1: Extract the CustomerIDs of the outliers and remove their transactions from the main dataframe
-        outlier_customer_ids = outliers_data['CustomerID'].astype('float').unique()
-        df_filtered = self.df[~self.df['CustomerID'].isin(outlier_customer_ids)]
 
-        # Step 2: Ensure consistent data type for CustomerID across both dataframes before merging
+        # Step 1: Ensure consistent data type for CustomerID across the customer data and the interaction index
         customer_data_cleaned['CustomerID'] = customer_data_cleaned['CustomerID'].astype('float')
 
-        # Step 3: Merge the transaction data with the customer data to get the cluster information for each transaction
-        merged_data = df_filtered.merge(customer_data_cleaned[['CustomerID', 'cluster']], on='CustomerID', how='inner')
-
-        # Step 4: Identify the top 10 best-selling products in each cluster based on the total quantity sold
-        best_selling_products = merged_data.groupby(['cluster', 'StockCode', 'Description'])['Quantity'].sum().reset_index()
-        best_selling_products = best_selling_products.sort_values(by=['cluster', 'Quantity'], ascending=[True, False])
-        top_products_per_cluster = best_selling_products.groupby('cluster').head(10)
-
-        # Step 5: Create a record of products purchased by each customer in each cluster
-        customer_purchases = merged_data.groupby(['CustomerID', 'cluster', 'StockCode'])['Quantity'].sum().reset_index()
-
-        # Step 6: Generate recommendations for each customer in each cluster
-        recommendations = []
-        for cluster in top_products_per_cluster['cluster'].unique():
-            top_products = top_products_per_cluster[top_products_per_cluster['cluster'] == cluster]
-            customers_in_cluster = customer_data_cleaned[customer_data_cleaned['cluster'] == cluster]['CustomerID']
-            
-            for customer in customers_in_cluster:
-                # Identify products already purchased by the customer
-                customer_purchased_products = customer_purchases[(customer_purchases['CustomerID'] == customer) & 
-                                                                (customer_purchases['cluster'] == cluster)]['StockCode'].tolist()
-                
-                # Find top 3 products in the best-selling list that the customer hasn't purchased yet
-                top_products_not_purchased = top_products[~top_products['StockCode'].isin(customer_purchased_products)]
-                top_3_products_not_purchased = top_products_not_purchased.head(3)
-                
-                # Append the recommendations to the list
-                recommendations.append([customer, cluster] + top_3_products_not_purchased[['StockCode', 'Description']].values.flatten().tolist())
-
-        # Step 7: Create a dataframe from the recommendations list and merge it with the original customer data
-        recommendations_df = pd.DataFrame(recommendations, columns=['CustomerID', 'cluster', 'Rec1_StockCode', 'Rec1_Description', \
-                                                        'Rec2_StockCode', 'Rec2_Description', 'Rec3_StockCode', 'Rec3_Description'])
+        # Step 2: Look up the interaction rows of the clustered customers (outliers are not part of customer_data_cleaned)
+        customer_codes = np.searchsorted(self.customer_ids, customer_data_cleaned['CustomerID'].to_numpy())
+        clusters = customer_data_cleaned['cluster'].to_numpy()
+        cluster_ids = np.unique(clusters)
+
+        # Step 3: Sum the quantities sold in each cluster with a sparse cluster indicator matrix
+        membership = sparse.csr_matrix((np.ones(len(customer_codes), dtype=np.int32), (np.searchsorted(cluster_ids, clusters), customer_codes)),
+                                       shape=(len(cluster_ids), len(self.customer_ids)))
+        cluster_quantities = (membership @ self.interactions).toarray()
+        cluster_presence = (membership @ self._interaction_presence()).toarray() > 0
+
+        # Step 4: Create a record of stock codes purchased by each customer
+        customer_purchases = self._purchased_stock_codes()
+
+        # Step 5: For each cluster, rank its products by quantity sold and recommend the first n_recs of the top 10 not purchased yet
+        recommendations, top_products_per_cluster = [], []
+        for position, cluster in enumerate(cluster_ids):
+            sold = np.flatnonzero(cluster_presence[position])
+            top_products = sold[np.lexsort((sold, -cluster_quantities[position, sold]))][:10]
+            top_products_per_cluster.append(self.products.iloc[top_products].assign(cluster=cluster, Rank=np.arange(len(top_products))))
+            in_cluster = clusters == cluster
+            if engine != 'cluster':
+                continue
+
+            # Encode the overlap between each customer's purchases and the top products as a boolean mask
+            rows = customer_codes[in_cluster]
+            purchased = customer_purchases[rows][:, self.product_stock_codes[top_products]].toarray() > 0
+            not_purchased_rank = np.where(purchased, 0, np.cumsum(~purchased, axis=1))
+
+            recommendation = {'CustomerID': customer_data_cleaned['CustomerID'].to_numpy()[in_cluster], 'cluster': cluster}
+            for rec in range(1, n_recs + 1):
+                has_rec = (not_purchased_rank == rec).any(axis=1)
+                picked = top_products[np.argmax(not_purchased_rank == rec, axis=1)]
+                for column in ['StockCode', 'Description']:
+                    values = self.products[column].to_numpy(dtype=object)[picked]
+                    values[~has_rec] = None
+                    recommendation['Rec{}_{}'.format(rec, column)] = values
+            recommendations.append(pd.DataFrame(recommendation))
+
+        # The co-occurrence engine picks each customer's products from the items bought together with their own purchases instead
+        if engine == 'cooccurrence':
+            recommendations = [self._cooccurrence_recommendations(customer_data_cleaned['CustomerID'].to_numpy(), customer_codes, clusters,
+                                                                  customer_purchases, n_recs, similarity, batch_size)]
+
+        # Step 6: Combine the recommendations and merge them with the original customer data
+        recommendations_df = pd.concat(recommendations, ignore_index=True)
         customer_data_with_recommendations = customer_data_cleaned.merge(recommendations_df, on=['CustomerID', 'cluster'], how='right')
 
         # Display 10 random rows from the customer_data_with_recommendations dataframe
-        customer_data_with_recommendations.set_index('CustomerID').iloc[:, -6:].sample(10, random_state=0)
+        customer_data_with_recommendations.set_index('CustomerID').iloc[:, -2 * n_recs:].sample(10, random_state=0)
 
         self.customer_data_with_recommendations = customer_data_with_recommendations
+        self.top_products = pd.concat(top_products_per_cluster, ignore_index=True)[['cluster', 'Rank', 'StockCode', 'Description']]
+        self.recommendation_engine = engine
+
+
+    def _cooccurrence_matrix(self, similarity='count'):
+        from scipy import sparse
+
+        # Basket x product presence matrix of the completed invoices; cancellations are returns, not baskets
+        completed = ~cancelled_transactions(self.df)
+        basket_codes, baskets = pd.factorize(self.df['InvoiceNo'][completed])
+        product_codes = self.df['Product_Code'].to_numpy()[completed]
+        presence = sparse.csr_matrix((np.ones(len(basket_codes), dtype=np.float32), (basket_codes, product_codes)),
+                                     shape=(len(baskets), len(self.products)))
+        presence.data[:] = 1
+
+        # Item x item counts of the baskets two products appear in together, without the diagonal
+        cooccurrence = (presence.T @ presence).tocsr()
+        cooccurrence.setdiag(0)
+        cooccurrence.eliminate_zeros()
+
+        # Cosine normalization divides by sqrt(baskets of i * baskets of j), so best-sellers do not dominate every list
+        if similarity == 'cosine':
+            norms = 1 / np.sqrt(np.maximum(np.asarray(presence.sum(axis=0)).ravel(), 1))
+            cooccurrence = sparse.diags(norms) @ cooccurrence @ sparse.diags(norms)
+        return cooccurrence.tocsr().astype(np.float32)
+
+
+    def _cooccurrence_recommendations(self, customer_ids, customer_codes, clusters, customer_purchases, n_recs, similarity, batch_size):
+        from scipy import sparse
+
+        cooccurrence = self._cooccurrence_matrix(similarity)
+
+        # Real baskets make the item x item matrix dense enough that a dense copy (4k products: 64 MB of float32)
+        # multiplies much faster than sparse x sparse
+        if cooccurrence.nnz > 0.05 * cooccurrence.shape[0] * cooccurrence.shape[1]:
+            cooccurrence = cooccurrence.toarray()
+        presence = self._interaction_presence().astype(np.float32)
+        n_products = len(self.products)
+        product_to_stock = sparse.csr_matrix((np.ones(n_products, dtype=np.float32), (np.arange(n_products), self.product_stock_codes)),
+                                             shape=(n_products, len(self.stock_codes)))
+        stock_codes = self.products['StockCode'].to_numpy(dtype=object)
+        descriptions = self.products['Description'].to_numpy(dtype=object)
+
+        # Score customers in batches: every product gets the summed similarity to the products the customer bought,
+        # products whose stock code was bought are excluded and the top n_recs are found with a partial sort
+        picked = np.full((len(customer_codes), n_recs), -1, dtype=np.int64)
+        for start in range(0, len(customer_codes), batch_size):
+            rows = customer_codes[start:start + batch_size]
+            scores = presence[rows] @ cooccurrence
+            scores = scores.toarray() if sparse.issparse(scores) else np.asarray(scores)
+            purchased = (customer_purchases[rows] @ product_to_stock.T).toarray() > 0
+            scores[purchased] = 0
+            k = min(n_recs, n_products)
+            kth_scores = np.take_along_axis(scores, np.argpartition(-scores, k - 1, axis=1)[:, k - 1:k], axis=1)
+
+            # The partition picks an arbitrary product among those tied at the k-th score, so keep every product scoring at
+            # least that much (products with no co-occurrence at all are dropped), order them by score, then product code,
+            # and take the first k of every customer
+            candidate_rows, candidates = np.nonzero((scores >= kth_scores) & (scores > 0))
+            order = np.lexsort((candidates, -scores[candidate_rows, candidates], candidate_rows))
+            candidate_rows, candidates = candidate_rows[order], candidates[order]
+            ranks = np.arange(len(candidate_rows)) - np.searchsorted(candidate_rows, candidate_rows)
+            keep = ranks < k
+            picked[start + candidate_rows[keep], ranks[keep]] = candidates[keep]
+
+        recommendation = {'CustomerID': customer_ids, 'cluster': clusters}
+        for rec in range(1, n_recs + 1):
+            has_rec = picked[:, rec - 1] >= 0
+            for column, values in [('StockCode', stock_codes), ('Description', descriptions)]:
+                column_values = values[np.where(has_rec, picked[:, rec - 1], 0)]
+                column_values[~has_rec] = None
+                recommendation['Rec{}_{}'.format(rec, column)] = column_values
+        return pd.DataFrame(recommendation)
+
+
+    def save_model_bundle(self, path='model_bundle.pkl'):
+        # Save everything needed to score new customers without refitting: the fitted transformers and models,
+        # the cluster label mapping and each cluster's ranked top products
+        bundle = {
+            'version': MODEL_BUNDLE_VERSION,
+            'feature_columns': list(self.customer_data.columns[1:].drop(['Outlier_Scores', 'Is_Outlier'], errors='ignore')),
+            'outlier_model': self.outlier_model,
+            'scaler': self.scaler,
+            'scaled_columns': self.scaled_columns,
+            'pca': self.pca,
+            'kmeans': self.kmeans,
+            'label_mapping': self.label_mapping,
+            'top_products': self.top_products,
+            'n_recs': len(recommendation_numbers(self.customer_data_with_recommendations.columns)),
+        }
+        write_pickle(bundle, path)
 
 
     def show_output(self):
         print(self.customer_data_with_recommendations.head())
 
 
-    def generate_output_csv(self):
-        self.customer_data_with_recommendations.to_csv("output.csv", index=False)
+    def generate_output_csv(self, path="output.csv", chunk_rows=OUTPUT_CHUNK_ROWS, partition_by=None, layout='wide', exceptions_only=False,
+                            verify=False):
+        # The writer is picked by the file extension (see OUTPUT_WRITERS), e.g. output.csv, output.csv.gz or output.npz;
+        # every file is written next to its target and moved into place, so a reader never sees half a table.
+        # Returns the layout and the files written, so readers can follow this run rather than whatever else is on disk
+        output = self.customer_data_with_recommendations
+        extension, write_table = output_writer(path)
+        files = []
+
+        def writer(table, target, chunk_rows):
+            with atomic_output(target) as temporary_path:
+                write_table(table, temporary_path, chunk_rows)
+            files.append(target)
+
+        # Normalized layout: a directory of tables that reference products by id, e.g. output/products.csv for output.csv;
+        # denormalize_recommendations rebuilds the recommendation columns of the wide table from them
+        if layout == 'normalized':
+            directory = check_output_path(path, layout)
+            # Co-occurrence recommendations are personal, there is no cluster default for them to be exceptions to
+            if exceptions_only and self.recommendation_engine == 'cooccurrence':
+                raise ValueError('exceptions_only needs the cluster engine, the co-occurrence engine has no cluster default')
+            tables = normalize_recommendations(output, self.products, self.top_products, exceptions_only=exceptions_only)
+            # The round trip rebuilds and compares every row, so it is a debugging aid rather than part of every write
+            if verify:
+                rebuilt = denormalize_recommendations(tables)
+                expected = output[rebuilt.columns]
+                if not rebuilt.astype(object).equals(expected.astype(object)):
+                    raise ValueError('The normalized recommendation tables do not rebuild the wide output')
+            os.makedirs(directory, exist_ok=True)
+            for name, table in tables.items():
+                writer(table, os.path.join(directory, name + extension), chunk_rows)
+
+            # An exceptions table left by an earlier exceptions-only run would otherwise be applied to these defaults
+            stale_exceptions = os.path.join(directory, 'recommendation_exceptions' + extension)
+            if not exceptions_only and os.path.exists(stale_exceptions):
+                os.remove(stale_exceptions)
+            return {'layout': 'normalized', 'files': files}
+
+        if partition_by is None:
+            writer(output, path, chunk_rows)
+            return {'layout': 'wide', 'files': files}
+
+        # Partitioned output: one file per value of the partition column, e.g. output/cluster=0.csv for output.csv
+        directory = check_output_path(path, layout, partition_by)
+        os.makedirs(directory, exist_ok=True)
+        for value, partition in output.groupby(partition_by, sort=True):
+            writer(partition, os.path.join(directory, '{}={}{}'.format(partition_by, value, extension)), chunk_rows)
+
+        # Remove the partitions of values this run no longer has (e.g. cluster=3 after a run with fewer clusters)
+        for name in os.listdir(directory):
+            stale = os.path.join(directory, name)
+            if name.startswith(partition_by + '=') and name.endswith(extension) and stale not in files:
+                os.remove(stale)
+        return {'layout': 'partitioned', 'files': files}
+
+
+# Bump whenever the layout of the saved model bundle changes
+MODEL_BUNDLE_VERSION = 2
+
+
+class ModelBundle:
+    def __init__(self, bundle):
+        self.bundle = bundle
+
+    @classmethod
+    def load(cls, path='model_bundle.pkl'):
+        with open(path, 'rb') as file:
+            bundle = pickle.load(file)
+        if bundle.get('version') != MODEL_BUNDLE_VERSION:
+            raise ValueError('Model bundle {} has version {}, expected {}'.format(path, bundle.get('version'), MODEL_BUNDLE_VERSION))
+        return cls(bundle)
+
+    def predict(self, customer_data):
+        # Assign clusters to a batch of customer feature rows with the fitted models, as the pipeline would
+        bundle = self.bundle
+        features = customer_data[bundle['feature_columns']]
+        is_outlier = bundle['outlier_model'].predict(features.to_numpy()) == -1
+        scaled = features.copy()
+        scaled[bundle['scaled_columns']] = bundle['scaler'].transform(scaled[bundle['scaled_columns']])
+        components = bundle['pca'].transform(scaled)
+        components = pd.DataFrame(components, columns=['PC' + str(i + 1) for i in range(components.shape[1])])
+        labels = bundle['kmeans'].predict(components)
+        clusters = np.array([bundle['label_mapping'][label] for label in labels])
+        return pd.DataFrame({'CustomerID': customer_data['CustomerID'].to_numpy(), 'cluster': clusters, 'Is_Outlier': is_outlier.astype(int)})
+
+    def recommend(self, customer_data=None, transactions=None):
+        # Score either customer feature rows or raw transactions; for transactions the features are engineered the
+        # same way as in training (customers with a single transaction row get no features) and purchased products are skipped
+        purchases = pd.DataFrame({'CustomerID': pd.Series(dtype='float64'), 'StockCode': pd.Series(dtype='str')})
+        if transactions is not None:
+            rec_system = RecommendationSystem(None)
+            rec_system.df = transactions
+            rec_system.clean_data()
+            rec_system.build_interaction_index()
+            rec_system.feature_engineer()
+            customer_data = rec_system.customer_data
+            purchases = rec_system.df[['CustomerID', 'StockCode']].astype({'StockCode': str}).drop_duplicates()
+        predictions = self.predict(customer_data)
+
+        # Pair every customer with the ranked top products of their cluster and keep the first n_recs not purchased yet
+        n_recs = self.bundle['n_recs']
+        top_products = self.bundle['top_products'].astype({'StockCode': str, 'Description': str})
+        candidates = predictions[['CustomerID', 'cluster']].reset_index().merge(top_products, on='cluster')
+        candidates = candidates.merge(purchases.assign(Purchased=True), on=['CustomerID', 'StockCode'], how='left')
+        candidates = candidates[candidates['Purchased'].isna()].sort_values(['index', 'Rank'])
+        candidates['Rec'] = candidates.groupby('index').cumcount() + 1
+        candidates = candidates[candidates['Rec'] <= n_recs]
+        recommendations = candidates.pivot(index='index', columns='Rec', values=['StockCode', 'Description'])
+        recommendations.columns = ['Rec{}_{}'.format(rec, column) for column, rec in recommendations.columns]
+        rec_columns = ['Rec{}_{}'.format(rec, column) for rec in range(1, n_recs + 1) for column in ['StockCode', 'Description']]
+        return predictions.join(recommendations.reindex(columns=rec_columns))
+
+
+# Pipeline stages in execution order: (method, attributes it reads, attributes it writes, code version)
+# Bump a stage's code version when its logic changes so its old checkpoints are not reused
+INTERACTION_INDEX = ['customer_ids', 'products', 'product_stock_codes', 'stock_codes', 'interactions']
+PIPELINE_STAGES = [
+    ('load_clean_data', [], ['df'], CLEANING_VERSION),
+    ('build_interaction_index', ['df'], ['df'] + INTERACTION_INDEX, 3),
+    ('feature_engineer', ['df'] + INTERACTION_INDEX, ['df', 'customer_data'], 5),
+    ('fix_outlier', ['customer_data'], ['customer_data', 'customer_data_cleaned', 'outliers_data', 'outlier_model'], 3),
+    ('feature_scale', ['customer_data_cleaned'], ['customer_data_scaled', 'scaler', 'scaled_columns'], 2),
+    ('dimensionality_reduction', ['customer_data_scaled'], ['customer_data_scaled', 'customer_data_pca', 'pca'], 4),
+    ('select_k', ['customer_data_pca'], ['optimal_k', 'k_selection'], 1),
+    ('kmeans_clustering', ['customer_data_cleaned', 'customer_data_pca', 'optimal_k'], ['customer_data_cleaned', 'customer_data_pca', 'kmeans', 'label_mapping'], 2),
+    ('recommendation_system', ['df', 'customer_data_cleaned'] + INTERACTION_INDEX, ['customer_data_cleaned', 'customer_data_with_recommendations', 'top_products', 'recommendation_engine'], 5),
+]
+
+# Stage -> parameters that only change how a stage runs (workers, shards, chunk sizes of the reader, scratch locations)
+# and not what it computes; they are left out of the stage key, so e.g. a different --jobs reuses the checkpoint
+RESULT_NEUTRAL_PARAMS = {
+    'load_clean_data': ['cache_dir', 'chunksize'],
+    'feature_engineer': ['n_jobs', 'n_shards'],
+    'fix_outlier': ['n_jobs'],
+    'select_k': ['n_jobs'],
+}
+
+# Stage -> parameters that name an input file; the stage key covers the file's size and modification time, not just its path
+FILE_PARAMS = {
+    'fix_outlier': ['bundle_path'],
+}
+
+# Bump whenever the checkpoint file layout changes, so checkpoints in the older layout are not read
+CHECKPOINT_FORMAT = 2
+
+# Stage -> frame output -> the columns the stage adds to or rewrites in that frame. The checkpoint stores only these
+# columns and points at the checkpoint the rest of the frame was loaded from, instead of pickling the whole frame again
+FRAME_DELTAS = {
+    'load_clean_data': {'df': []},
+    'build_interaction_index': {'df': ['Customer_Code', 'Product_Code']},
+    'feature_engineer': {'df': ['InvoiceDate', 'InvoiceDay', 'Total_Spend', 'Day_Of_Week', 'Hour', 'Year', 'Month']},
+}
+
+# Stage -> frame output -> attribute naming a file that holds an identical copy of the frame, used as its checkpoint base
+FRAME_FILES = {
+    'load_clean_data': {'df': 'clean_cache_path'},
+}
+
+
+class FrameDelta:
+    # Checkpointed frame: the columns of `changed` on top of the same frame in the checkpoint (or npz cache) at `base`
+    def __init__(self, base, columns, changed):
+        self.base = base
+        self.columns = columns
+        self.changed = changed
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return '{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class PipelineRunner:
+    def __init__(self, rec_system, params=None, checkpoint_dir=os.path.join('.cache', 'stages'), profiler=None, keep_checkpoints=2):
+        self.rec_system = rec_system
+        self.params = params or {}
+        self.checkpoint_dir = checkpoint_dir
+        self.profiler = profiler
+        self.keep_checkpoints = keep_checkpoints
+        self.memory_report = None
+
+        # Frame attribute -> (file it was loaded from or checkpointed to, its index, its column dtypes)
+        self.frame_sources = {}
+
+    def stage_keys(self):
+        # The first stage is keyed on the input file's fingerprint
+        producers = {'__input__': '{}:{}'.format(file_fingerprint(self.rec_system.file_path), 'compact' if self.rec_system.compact else 'default')}
+
+        # Every stage is keyed on its name, version and parameters plus the keys of the stages that produced its inputs,
+        # so changing a parameter only invalidates that stage and the stages downstream of it
+        keys = {}
+        for method, inputs, outputs, version in PIPELINE_STAGES:
+            lineage = sorted({producers.get(attribute, producers['__input__']) for attribute in inputs} or {producers['__input__']})
+            params = {name: value for name, value in self.params.get(method, {}).items() if name not in RESULT_NEUTRAL_PARAMS.get(method, [])}
+            params.update({name: file_fingerprint(params[name]) for name in FILE_PARAMS.get(method, []) if params.get(name)})
+            content = json.dumps([method, version, CHECKPOINT_FORMAT, params, lineage], sort_keys=True, default=str)
+            keys[method] = hashlib.sha256(content.encode()).hexdigest()[:16]
+            producers.update({attribute: keys[method] for attribute in outputs})
+        return keys
+
+    def checkpoint_path(self, method, key):
+        return os.path.join(self.checkpoint_dir, '{}_{}.pkl'.format(method, key))
+
+    def run(self):
+        keys = self.stage_keys()
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        # Track which checkpoint holds the latest value of every attribute that is not loaded in memory yet
+        pending = {}
+        memory_report = []
+        for method, inputs, outputs, version in PIPELINE_STAGES:
+            path = self.checkpoint_path(method, keys[method])
+            if self._checkpoint_ready(path):
+                print('{}: cached'.format(method))
+                if self.profiler:
+                    self.profiler.record_cached(method)
+                pending.update({attribute: path for attribute in outputs})
+                continue
+
+            # Load the inputs this stage needs from upstream checkpoints, then run it and checkpoint its outputs
+            self._load_attributes(inputs, pending)
+            start = time.perf_counter()
+            getattr(self.rec_system, method)(**self.params.get(method, {}))
+            print('{}: ran in {:.2f}s'.format(method, time.perf_counter() - start))
+            self._write_checkpoint(method, path, outputs)
+            for attribute in outputs:
+                pending.pop(attribute, None)
+
+            # Record the size of the stage's outputs and the process's peak resident memory so far
+            memory_report.append({'Stage': method, 'Output_MB': sum(memory_usage_bytes(getattr(self.rec_system, attribute)) for attribute in outputs) / 2 ** 20,
+                                  'Peak_RSS_MB': peak_rss_mb()})
+
+        if memory_report:
+            self.memory_report = pd.DataFrame(memory_report)
+            print(self.memory_report.to_string(index=False, float_format='{:.1f}'.format))
+
+        # Make sure the final results are in memory even when every stage was cached
+        self._load_attributes(list(pending), pending)
+        self.prune_checkpoints(keys)
+        return self.rec_system
+
+    def prune_checkpoints(self, keys):
+        # Keep the checkpoint of the current run and the keep_checkpoints - 1 newest others of every stage, plus every
+        # checkpoint they are stored on top of; older checkpoints are removed
+        files = os.listdir(self.checkpoint_dir)
+        kept = set()
+        for method, _, _, _ in PIPELINE_STAGES:
+            pattern = re.compile(r'{}_[0-9a-f]{{16}}\.pkl$'.format(re.escape(method)))
+            paths = sorted((os.path.join(self.checkpoint_dir, name) for name in files if pattern.match(name)), key=os.path.getmtime, reverse=True)
+            current = self.checkpoint_path(method, keys[method])
+            kept.update([current] + [path for path in paths if path != current][:max(self.keep_checkpoints - 1, 0)])
+        pending = list(kept)
+        while pending:
+            for base in self._checkpoint_bases(pending.pop()):
+                if base not in kept:
+                    kept.add(base)
+                    pending.append(base)
+
+        for name in files:
+            path = os.path.join(self.checkpoint_dir, name)
+            if path not in kept and (name.endswith('.pkl') or name.endswith('.tmp')):
+                os.remove(path)
+
+    def _checkpoint_bases(self, path):
+        # The files a checkpoint's frames are stored on top of, read from its header without loading the checkpoint
+        if not path.endswith('.pkl') or not os.path.exists(path):
+            return []
+        with open(path, 'rb') as file:
+            return pickle.load(file)['bases']
+
+    def _checkpoint_ready(self, path):
+        return os.path.exists(path) and all(self._checkpoint_ready(base) if base.endswith('.pkl') else os.path.exists(base)
+                                            for base in self._checkpoint_bases(path))
+
+    def _read_checkpoint(self, path):
+        # Rebuild every frame stored as a delta from the frame it was stored on top of
+        with open(path, 'rb') as file:
+            pickle.load(file)
+            checkpoint = pickle.load(file)
+        for attribute, value in checkpoint.items():
+            if isinstance(value, FrameDelta):
+                base = read_frame_npz(value.base) if value.base.endswith('.npz') else self._read_checkpoint(value.base)[attribute]
+                checkpoint[attribute] = base.assign(**{column: value.changed[column] for column in value.changed.columns})[value.columns]
+        return checkpoint
+
+    def _load_attributes(self, attributes, pending):
+        for path in {pending[attribute] for attribute in attributes if attribute in pending}:
+            checkpoint = self._read_checkpoint(path)
+            for attribute, value in checkpoint.items():
+                if pending.get(attribute) == path:
+                    setattr(self.rec_system, attribute, value)
+                    pending.pop(attribute)
+                    self._record_frame_source(attribute, value, path)
+
+    def _record_frame_source(self, attribute, value, path):
+        if isinstance(value, pd.DataFrame):
+            self.frame_sources[attribute] = (path, value.index, value.dtypes.to_dict())
+
+    def _write_checkpoint(self, method, path, outputs):
+        for attribute, file_attribute in FRAME_FILES.get(method, {}).items():
+            self._record_frame_source(attribute, getattr(self.rec_system, attribute), getattr(self.rec_system, file_attribute))
+
+        # Store a frame as the columns the stage changed when the rest of it still matches the copy it was loaded from,
+        # i.e. the same rows and the same dtypes for every other column; otherwise store the whole frame
+        checkpoint = {}
+        for attribute in outputs:
+            value = getattr(self.rec_system, attribute)
+            changed = FRAME_DELTAS.get(method, {}).get(attribute)
+            source = self.frame_sources.get(attribute)
+            if changed is not None and source is not None and value.index.equals(source[1]) and set(changed) <= set(value.columns) and all(
+                    column in changed or source[2].get(column) == dtype for column, dtype in value.dtypes.items()):
+                value = FrameDelta(source[0], list(value.columns), value[changed])
+            checkpoint[attribute] = value
+
+        # The header lists the files the deltas are stored on top of, so readiness and pruning can check them cheaply
+        bases = sorted({value.base for value in checkpoint.values() if isinstance(value, FrameDelta)})
+        with atomic_output(path) as temporary_path:
+            with open(temporary_path, 'wb') as file:
+                pickle.dump({'bases': bases}, file, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(checkpoint, file, protocol=pickle.HIGHEST_PROTOCOL)
+        for attribute in outputs:
+            self._record_frame_source(attribute, getattr(self.rec_system, attribute), path)
 
 
 if __name__ == "__main__":
-    print("Recommendation System")
-    rec_system = RecommendationSystem("data.csv")
-    rec_system.load_data()
-    rec_system.clean_data()
-    rec_system.feature_engineer()
-    rec_system.fix_outlier()
-    rec_system.feature_scale()
-    rec_system.dimensionality_reduction()
-    rec_system.kmeans_clustering()
-    rec_system.recommendation_system()
-    rec_system.show_output()
-    rec_system.generate_output_csv()
+    # Running this file directly runs the full pipeline through the command-line entry point in recommend.py
+    import sys
+    import recommend
+    recommend.main(['run'] + sys.argv[1:])
@@ -0,0 +1,349 @@
+import argparse
+import os
+import time
+
+# Only the standard library is imported at module load so `--help` and lookups start instantly;
+# the pipeline (pandas, scipy, scikit-learn) is imported by the subcommands that need it
+
+
+def max_samples(value):
+    # IsolationForest accepts 'auto', a number of rows or a fraction of the rows
+    if value == 'auto':
+        return value
+    return float(value) if '.' in value else int(value)
+
+
+def build_runner(args, profiler=None):
+    from recomendation_system import PipelineRunner, RecommendationSystem
+
+    params = {
+        'load_clean_data': {'cache_dir': args.cache_dir, 'chunksize': args.chunksize},
+        'feature_engineer': {'n_jobs': args.feature_jobs, 'n_shards': args.feature_shards},
+        'fix_outlier': {'contamination': args.contamination, 'n_jobs': args.outlier_jobs, 'max_samples': args.outlier_max_samples,
+                        'sample_size': args.outlier_sample_size, 'bundle_path': args.outlier_bundle},
+        'dimensionality_reduction': {'n_components': args.components, 'variance_threshold': args.variance_threshold,
+                                     'method': args.pca, 'batch_size': args.batch_size},
+        'select_k': {'candidates': list(range(args.min_k, args.max_k + 1)) if args.clusters == 'auto' else None,
+                     'sample_size': args.k_sample_size, 'n_jobs': args.jobs},
+        'kmeans_clustering': {'n_clusters': args.clusters if args.clusters == 'auto' else int(args.clusters), 'method': args.clustering, 'batch_size': args.batch_size,
+                              'compare': args.compare_clustering},
+        'recommendation_system': {'engine': args.engine, 'n_recs': args.n_recs, 'similarity': args.similarity},
+    }
+    rec_system = RecommendationSystem(args.input, compact=args.compact)
+    if profiler:
+        profiler.instrument(rec_system)
+    return PipelineRunner(rec_system, params, checkpoint_dir=os.path.join(args.cache_dir, 'stages'), profiler=profiler,
+                          keep_checkpoints=args.keep_checkpoints)
+
+
+def run(args):
+    from recomendation_system import check_output_path
+    from recommendation_server import write_ready_marker
+    from stage_profiler import StageProfiler
+
+    # Check the output path before any stage runs, a collision would otherwise only surface after the whole pipeline
+    try:
+        check_output_path(args.output, args.layout, args.partition_by)
+    except (ValueError, ImportError) as error:
+        raise SystemExit('recommend.py run: error: {}'.format(error))
+
+    print("Recommendation System")
+    profiler = StageProfiler(args.cprofile_dir, trace_memory=not args.no_trace_memory) if args.profile_report or args.chrome_trace or args.cprofile_dir else None
+    rec_system = build_runner(args, profiler).run()
+    rec_system.show_output()
+    written = rec_system.generate_output_csv(args.output, chunk_rows=args.chunk_rows, partition_by=args.partition_by, layout=args.layout,
+                                             exceptions_only=args.exceptions_only, verify=args.verify_layout)
+    rec_system.save_model_bundle(args.bundle)
+    # Signal a running server that the table and the bundle of this run are both complete, and which files the table is
+    write_ready_marker(args.output, args.bundle, written)
+
+    # Write the per-stage timings, memory and shapes of this run
+    if args.profile_report:
+        profiler.write_report(args.profile_report)
+    if args.chrome_trace:
+        profiler.write_chrome_trace(args.chrome_trace)
+
+
+def score(args):
+    from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, silhouette_score
+    from tabulate import tabulate
+
+    # Score the clustering of the (usually cached) pipeline run; silhouette is O(n^2) so it runs on a sample
+    rec_system = build_runner(args).run()
+    features = rec_system.customer_data_pca.drop(columns=['cluster'])
+    labels = rec_system.customer_data_pca['cluster']
+    sample_size = min(args.sample_size, len(features))
+    rows = [
+        ['Silhouette (sample of {})'.format(sample_size), silhouette_score(features, labels, sample_size=sample_size, random_state=0)],
+        ['Calinski-Harabasz', calinski_harabasz_score(features, labels)],
+        ['Davies-Bouldin', davies_bouldin_score(features, labels)],
+    ]
+    print(tabulate(rows, headers=['Metric', 'Score'], tablefmt='pretty'))
+
+
+def predict(args):
+    from recomendation_system import ModelBundle, RecommendationSystem
+
+    # Score new customers from raw transactions with a saved model bundle, without refitting
+    bundle = ModelBundle.load(args.bundle)
+    transactions = RecommendationSystem(args.transactions)
+    transactions.load_data()
+    start = time.perf_counter()
+    recommendations = bundle.recommend(transactions=transactions.df)
+    print('Scored {} customers in {:.1f} ms'.format(len(recommendations), (time.perf_counter() - start) * 1000))
+    recommendations.to_csv(args.output, index=False)
+
+
+def recommendation_rows(path):
+    # Rows of any recommendation table written by `run`, with a clear error instead of a traceback for anything else
+    from recommendation_server import recommendation_rows as read_rows
+
+    try:
+        yield from read_rows(path)
+    except (ValueError, ImportError, FileNotFoundError) as error:
+        raise SystemExit('recommend.py: error: {}'.format(error))
+
+
+def update(args):
+    from recomendation_system import RecommendationSystem, atomic_output, output_writer
+
+    # Fold a new batch of transactions into the saved per-customer state and write the features over the whole history
+    try:
+        extension, writer = output_writer(args.output)
+    except (ValueError, ImportError) as error:
+        raise SystemExit('recommend.py update: error: {}'.format(error))
+    rec_system = RecommendationSystem(args.transactions, compact=args.compact)
+    rec_system.load_data(chunksize=args.chunksize)
+    rec_system.clean_data()
+    try:
+        rec_system.feature_engineer_incremental(state_path=args.state)
+    except ValueError as error:
+        raise SystemExit('recommend.py update: error: {}'.format(error))
+    with atomic_output(args.output) as temporary_path:
+        writer(rec_system.customer_data, temporary_path)
+    print('Folded {} transactions into {}, {} customers'.format(len(rec_system.df), args.state, len(rec_system.customer_data)))
+
+
+def lookup(args):
+    from recommendation_server import recommendation_numbers
+
+    # Scan the recommendation table (streamed with the csv module for plain CSV) and stop once every requested customer was found
+    wanted = {float(customer_id) for customer_id in args.customer_ids}
+    found = {}
+    for row in recommendation_rows(args.recommendations):
+        customer_id = float(row['CustomerID'])
+        if customer_id in wanted:
+            found[customer_id] = row
+            if len(found) == len(wanted):
+                break
+
+    for customer_id in args.customer_ids:
+        row = found.get(float(customer_id))
+        if row is None:
+            print('{}: no recommendations'.format(customer_id))
+            continue
+        recommendations = ['{} {}'.format(row['Rec{}_StockCode'.format(rec)], row['Rec{}_Description'.format(rec)].strip())
+                           for rec in recommendation_numbers(row) if row['Rec{}_StockCode'.format(rec)]]
+        print('{} (cluster {}): {}'.format(customer_id, row['cluster'], '; '.join(recommendations) or 'none'))
+
+
+def serve(args):
+    import asyncio
+    from recomendation_system import output_writer
+    from recommendation_server import serve as serve_recommendations
+
+    try:
+        output_writer(args.recommendations)
+    except (ValueError, ImportError) as error:
+        raise SystemExit('recommend.py serve: error: {}'.format(error))
+    try:
+        asyncio.run(serve_recommendations(args.recommendations, args.bundle, args.host, args.port, args.cache_size, args.reload_interval))
+    except KeyboardInterrupt:
+        pass
+
+
+def loadgen(args):
+    import asyncio
+    from recommendation_server import generate_load
+
+    # Request random customers of the recommendation table, plus a share of unknown ids to exercise 404s
+    customer_ids = [row['CustomerID'] for row in recommendation_rows(args.recommendations)]
+    customer_ids += ['0'] * int(len(customer_ids) * args.unknown_share)
+    report = asyncio.run(generate_load(customer_ids, args.host, args.port, args.requests, args.concurrency))
+    print('{requests} requests in {seconds:.2f}s: {requests_per_second:.0f} req/s, '
+          'p50 {p50_ms:.2f} ms, p95 {p95_ms:.2f} ms, p99 {p99_ms:.2f} ms, statuses {statuses}'.format(**report))
+
+
+def generate(args):
+    from benchmark import generate_transactions, parse_size
+
+    generate_transactions(parse_size(args.rows), args.output, seed=args.seed)
+
+
+def benchmark(args):
+    import json
+    from tabulate import tabulate
+    from benchmark import compare, run_size
+
+    # Time every stage at each size in a fresh process, then compare against the stored baseline
+    results = {}
+    for size in args.sizes:
+        results[size] = run_size(size, args.data_dir, seed=args.seed, trace_memory=args.trace_memory)
+        print('{}: {:.2f}s, peak RSS {:.0f} MB'.format(size, results[size]['total_seconds'], results[size]['peak_rss_mb']))
+    with open(args.results, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    rows = [[size, stage, metrics['wall_seconds'], metrics['cpu_seconds'], metrics['rss_growth_mb'], metrics['peak_rss_mb']]
+            for size, result in results.items() for stage, metrics in result['stages'].items()]
+    print(tabulate(rows, headers=['Size', 'Stage', 'Wall (s)', 'CPU (s)', 'RSS growth (MB)', 'Peak RSS (MB)'], tablefmt='psql', floatfmt='.2f'))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print('Saved the baseline to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            comparison = compare(results, json.load(file), threshold=args.threshold)
+        regressions = comparison[comparison['Regression']].drop(columns=['Regression'])
+        if len(regressions):
+            print(tabulate(regressions, headers='keys', tablefmt='psql', showindex=False, floatfmt='.3f'))
+            print('{} regressions beyond {:.0%} against {}'.format(len(regressions), args.threshold, args.baseline))
+            raise SystemExit(1)
+        print('No regressions beyond {:.0%} against {}'.format(args.threshold, args.baseline))
+
+
+def add_pipeline_arguments(parser):
+    parser.add_argument('--input', default='data.csv', help='transaction CSV (default: data.csv)')
+    parser.add_argument('--cache-dir', default='.cache', help='directory for the cleaned-data cache and stage checkpoints')
+    parser.add_argument('--keep-checkpoints', type=int, default=2,
+                        help='stage checkpoints kept per stage, the current run included; older ones are removed (default: 2)')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the transactions and features in compact dtypes (categoricals, a cancellation flag, small ints, float32)')
+    parser.add_argument('--chunksize', type=int, default=None, help='read the input CSV in chunks of this many rows')
+    parser.add_argument('--feature-jobs', type=int, default=None, help='worker processes for sharded feature engineering (default: serial)')
+    parser.add_argument('--feature-shards', type=int, default=None, help='CustomerID hash shards for feature engineering (default: one per worker)')
+    parser.add_argument('--contamination', type=float, default=0.05, help='IsolationForest contamination (default: 0.05)')
+    parser.add_argument('--outlier-jobs', type=int, default=None, help='threads for building and scoring the IsolationForest (-1: every core)')
+    parser.add_argument('--outlier-max-samples', type=max_samples, default='auto', help="rows drawn per IsolationForest tree, a count, a fraction or 'auto' (default: auto)")
+    parser.add_argument('--outlier-sample-size', type=int, default=None, help='fit the IsolationForest on a random sample of this many customers')
+    parser.add_argument('--outlier-bundle', default=None,
+                        help='score outliers with the IsolationForest of this saved model bundle instead of fitting one')
+    parser.add_argument('--components', type=int, default=6,
+                        help='number of PCA components, the upper bound with --variance-threshold (default: 6)')
+    parser.add_argument('--variance-threshold', type=float, default=None, help='keep the fewest components explaining this share of the variance')
+    parser.add_argument('--pca', choices=['full', 'randomized', 'incremental'], default='full',
+                        help='exact PCA, randomized-SVD PCA, or IncrementalPCA over chunks (default: full)')
+    parser.add_argument('--clusters', default='3', help="number of KMeans clusters, or 'auto' to select it (default: 3)")
+    parser.add_argument('--min-k', type=int, default=2, help='smallest k tried by --clusters auto (default: 2)')
+    parser.add_argument('--max-k', type=int, default=10, help='largest k tried by --clusters auto (default: 10)')
+    parser.add_argument('--k-sample-size', type=int, default=10000, help='rows sampled for the silhouette score of each k (default: 10000)')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes for k selection (default: one per core)')
+    parser.add_argument('--engine', choices=['cluster', 'cooccurrence'], default='cluster',
+                        help="cluster best-sellers, or products bought together with the customer's own purchases (default: cluster)")
+    parser.add_argument('--n-recs', type=int, default=3,
+                        help="recommendations per customer; the cluster engine picks them from each cluster's top 10 (default: 3)")
+    parser.add_argument('--similarity', choices=['count', 'cosine'], default='count',
+                        help='co-occurrence engine: raw basket counts or cosine-normalized (default: count)')
+    parser.add_argument('--clustering', choices=['full', 'minibatch'], default='full',
+                        help='full KMeans, or MiniBatchKMeans streamed over chunks of the PCA matrix (default: full)')
+    parser.add_argument('--batch-size', type=int, default=4096, help='chunk size for incremental PCA and minibatch clustering (default: 4096)')
+    parser.add_argument('--compare-clustering', action='store_true', help='with minibatch clustering, also fit full KMeans and compare inertia')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Customer segmentation and product recommendation pipeline.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the pipeline and write the recommendation table')
+    add_pipeline_arguments(run_parser)
+    run_parser.add_argument('--output', default='output.csv',
+                            help='recommendation table to write; .csv, .csv.gz, .csv.zst or .npz picks the format (default: output.csv)')
+    run_parser.add_argument('--chunk-rows', type=int, default=100000, help='rows converted to text per chunk by the CSV writers (default: 100000)')
+    run_parser.add_argument('--layout', choices=['wide', 'normalized'], default='wide',
+                            help='one wide table, or a directory of product, cluster top-product and customer recommendation tables named after --output '
+                                 'without its extension, e.g. output/ for output.csv (default: wide)')
+    run_parser.add_argument('--exceptions-only', action='store_true',
+                            help="with --layout normalized, only store the recommendations that differ from the cluster's default")
+    run_parser.add_argument('--verify-layout', action='store_true',
+                            help='with --layout normalized, check that the tables rebuild the recommendations of the wide table before writing them')
+    run_parser.add_argument('--partition-by', choices=['cluster'], default=None, help='write one file per cluster into a directory named after --output without its extension')
+    run_parser.add_argument('--bundle', default='model_bundle.pkl', help='model bundle to save (default: model_bundle.pkl)')
+    run_parser.add_argument('--profile-report', default=None, help='write a JSON report of per-stage wall/CPU time, peak traced memory and shapes')
+    run_parser.add_argument('--chrome-trace', default=None, help='write the stage timings as a Chrome trace (chrome://tracing, Perfetto)')
+    run_parser.add_argument('--no-trace-memory', action='store_true', help='leave out the tracemalloc peak, which slows allocation-heavy stages down')
+    run_parser.add_argument('--cprofile-dir', default=None, help='write a cProfile capture of every top-level stage to this directory')
+    run_parser.set_defaults(handler=run)
+
+    score_parser = subparsers.add_parser('score', help='report clustering quality scores for a pipeline run')
+    add_pipeline_arguments(score_parser)
+    score_parser.add_argument('--sample-size', type=int, default=10000, help='rows sampled for the silhouette score (default: 10000)')
+    score_parser.set_defaults(handler=score)
+
+    predict_parser = subparsers.add_parser('predict', help='score customers in a transaction CSV with a saved model bundle')
+    predict_parser.add_argument('transactions', help='CSV of new transactions in the input schema')
+    predict_parser.add_argument('--bundle', default='model_bundle.pkl', help='model bundle to load (default: model_bundle.pkl)')
+    predict_parser.add_argument('--output', default='predictions.csv', help='CSV to write the clusters and recommendations to (default: predictions.csv)')
+    predict_parser.set_defaults(handler=predict)
+
+    update_parser = subparsers.add_parser('update', help='fold a new batch of transactions into the incremental customer features')
+    update_parser.add_argument('transactions', help='CSV of new transactions in the input schema')
+    update_parser.add_argument('--state', default=os.path.join('.cache', 'customer_state.pkl'),
+                               help='per-customer aggregates of the batches folded so far (default: .cache/customer_state.pkl)')
+    update_parser.add_argument('--output', default='customer_features.csv',
+                               help='customer feature table to write; .csv, .csv.gz, .csv.zst or .npz picks the format (default: customer_features.csv)')
+    update_parser.add_argument('--compact', action='store_true', help='keep the transactions and features in compact dtypes')
+    update_parser.add_argument('--chunksize', type=int, default=None, help='read the batch CSV in chunks of this many rows')
+    update_parser.set_defaults(handler=update)
+
+    serve_parser = subparsers.add_parser('serve', help='serve recommendations over local HTTP with hot reload')
+    serve_parser.add_argument('--recommendations', default='output.csv', help='recommendation table written by run, in any of its formats and layouts (default: output.csv)')
+    serve_parser.add_argument('--bundle', default='model_bundle.pkl', help='model bundle for scoring unknown customers (default: model_bundle.pkl)')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--cache-size', type=int, default=10000, help='LRU size for on-the-fly scores (default: 10000)')
+    serve_parser.add_argument('--reload-interval', type=float, default=2.0, help='seconds between checks for a new pipeline run (default: 2)')
+    serve_parser.set_defaults(handler=serve)
+
+    loadgen_parser = subparsers.add_parser('loadgen', help='measure latency and throughput of a running server')
+    loadgen_parser.add_argument('--recommendations', default='output.csv', help='recommendation table to draw customer ids from (default: output.csv)')
+    loadgen_parser.add_argument('--host', default='127.0.0.1')
+    loadgen_parser.add_argument('--port', type=int, default=8000)
+    loadgen_parser.add_argument('--requests', type=int, default=10000)
+    loadgen_parser.add_argument('--concurrency', type=int, default=32)
+    loadgen_parser.add_argument('--unknown-share', type=float, default=0.0, help='extra share of unknown customer ids to request (default: 0)')
+    loadgen_parser.set_defaults(handler=loadgen)
+
+    lookup_parser = subparsers.add_parser('lookup', help='print the recommendations of customers from a recommendation table')
+    lookup_parser.add_argument('customer_ids', nargs='+', metavar='CustomerID')
+    lookup_parser.add_argument('--recommendations', default='output.csv', help='recommendation table written by run, in any of its formats and layouts (default: output.csv)')
+    lookup_parser.set_defaults(handler=lookup)
+
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic Online-Retail-style transaction CSV')
+    generate_parser.add_argument('rows', help="number of rows, e.g. 10k, 1M or 50M")
+    generate_parser.add_argument('output', help='CSV to write')
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.set_defaults(handler=generate)
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='time every stage on synthetic data and compare against a baseline')
+    benchmark_parser.add_argument('--sizes', nargs='+', default=['10k', '1M'], help='data sizes to run, e.g. 10k 1M 50M (default: 10k 1M)')
+    benchmark_parser.add_argument('--data-dir', default=os.path.join('.cache', 'benchmark'), help='directory for the generated inputs')
+    benchmark_parser.add_argument('--seed', type=int, default=0)
+    benchmark_parser.add_argument('--results', default='benchmark_results.json', help='JSON file to write the results to')
+    benchmark_parser.add_argument('--baseline', default='benchmark_baseline.json', help='stored results to compare against')
+    benchmark_parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline instead of comparing')
+    benchmark_parser.add_argument('--threshold', type=float, default=0.25, help='relative slowdown or memory growth flagged as a regression (default: 0.25)')
+    benchmark_parser.add_argument('--trace-memory', action='store_true', help='also record the tracemalloc peak of every stage (slower)')
+    benchmark_parser.set_defaults(handler=benchmark)
+
+    args = parser.parse_args(argv)
+    # Reject option combinations that would only fail once the whole pipeline has run
+    if args.command == 'run' and args.exceptions_only and args.engine == 'cooccurrence':
+        parser.error('--exceptions-only needs --engine cluster, the co-occurrence engine has no cluster default to compare against')
+    start = time.perf_counter()
+    args.handler(args)
+    if args.command in ('run', 'score', 'predict', 'update'):
+        print('{} finished in {:.2f}s'.format(args.command, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+import asyncio
+import csv
+import functools
+import itertools
+import json
+import os
+import random
+import time
+
+# A small local HTTP/1.1 server over the precomputed recommendation table, built on asyncio streams only.
+# Known customers are answered from memory; unknown customers sent with their features are scored with the
+# saved model bundle (see ModelBundle in recomendation_system.py) and cached in an LRU.
+
+# JSON values accepted as a feature value or customer id; lists and objects are rejected with a 400 rather than failing
+# later as unhashable cache keys
+SCALAR_TYPES = (int, float, str, bool, type(None))
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def recommendation_numbers(columns, suffix='StockCode'):
+    # 1..n_recs for the Rec1..RecN columns a recommendation table was written with
+    return list(itertools.takewhile(lambda rec: 'Rec{}_{}'.format(rec, suffix) in columns, itertools.count(1)))
+
+
+def ready_marker_path(recommendations_path):
+    # `recommend.py run` writes this marker after both the recommendation table and the model bundle are in place
+    return recommendations_path + '.ready'
+
+
+def write_ready_marker(recommendations_path, bundle_path, written):
+    # `written` is the layout and files returned by generate_output_csv; readers follow them instead of guessing, so a
+    # wide file or directory left by an earlier run of the other layout is never read
+    from recomendation_system import atomic_output
+
+    with atomic_output(ready_marker_path(recommendations_path)) as temporary_path:
+        with open(temporary_path, 'w') as file:
+            json.dump({'recommendations': recommendations_path, 'bundle': bundle_path, 'layout': written['layout'],
+                       'files': written['files'], 'finished': time.time()}, file)
+
+
+def read_ready_marker(recommendations_path):
+    # The layout and files of the last run that wrote this output, or None for outputs without a (readable) marker
+    try:
+        with open(ready_marker_path(recommendations_path)) as file:
+            marker = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return {'layout': marker['layout'], 'files': marker['files']} if 'files' in marker else None
+
+
+def recommendation_rows(path):
+    # Rows of a recommendation table as dicts of strings, '' where a value is missing. A plain CSV file is streamed with the
+    # csv module; the other outputs of `recommend.py run` (.csv.gz, .csv.zst, .npz, normalized or partitioned directories)
+    # are read with read_recommendation_table, which raises ValueError for any other format
+    written = read_ready_marker(path)
+    wide_file = written['files'][0] if written and written['layout'] == 'wide' else path if not written else None
+    if wide_file and wide_file.endswith('.csv') and os.path.isfile(wide_file):
+        with open(wide_file, newline='') as file:
+            yield from csv.DictReader(file)
+        return
+
+    from recomendation_system import read_recommendation_table
+
+    table = read_recommendation_table(path, written)
+    table = table.astype(object).where(table.notna(), None)
+    for values in table.itertuples(index=False, name=None):
+        yield {column: '' if value is None else str(value) for column, value in zip(table.columns, values)}
+
+
+def read_recommendations(path):
+    # Load the recommendation table into a dict of CustomerID -> response record
+    table = {}
+    for row in recommendation_rows(path):
+        recommendations = [{'StockCode': row['Rec{}_StockCode'.format(rec)], 'Description': row['Rec{}_Description'.format(rec)]}
+                           for rec in recommendation_numbers(row) if row['Rec{}_StockCode'.format(rec)]]
+        table[float(row['CustomerID'])] = {'CustomerID': float(row['CustomerID']), 'cluster': int(row['cluster']),
+                                           'recommendations': recommendations}
+    return table
+
+
+class RecommendationService:
+    def __init__(self, recommendations_path='output.csv', bundle_path='model_bundle.pkl', cache_size=10000):
+        self.recommendations_path = recommendations_path
+        self.bundle_path = bundle_path
+        self.cache_size = cache_size
+        self.table = {}
+        self.top_products = {}
+        self.bundle = None
+        self.score_customer = None
+        self.loaded_marker_mtime = None
+
+    def marker_mtime(self):
+        # Only the ready marker is watched: it is written after the table and the bundle, so a run that is still writing
+        # them (or has replaced the table but not yet the bundle) never triggers a reload
+        marker = ready_marker_path(self.recommendations_path)
+        return os.stat(marker).st_mtime_ns if os.path.exists(marker) else None
+
+    def reload(self):
+        # Swap in the tables of the latest pipeline run; readers keep using the old dicts until the assignment
+        marker_mtime = self.marker_mtime()
+        table = read_recommendations(self.recommendations_path)
+        bundle, top_products = None, {}
+        if os.path.exists(self.bundle_path):
+            from recomendation_system import ModelBundle
+
+            bundle = ModelBundle.load(self.bundle_path)
+            for row in bundle.bundle['top_products'].itertuples(index=False):
+                top_products.setdefault(int(row.cluster), []).append({'StockCode': str(row.StockCode), 'Description': str(row.Description)})
+        self.table, self.bundle, self.top_products, self.loaded_marker_mtime = table, bundle, top_products, marker_mtime
+
+        # A new bundle invalidates every cached on-the-fly score
+        self.score_customer = functools.lru_cache(maxsize=self.cache_size)(self._score_customer)
+        print('Loaded {} customers and {} cluster top lists'.format(len(table), len(top_products)))
+
+    def _score_customer(self, features):
+        import pandas as pd
+
+        result = self.bundle.recommend(customer_data=pd.DataFrame([dict(features)])).iloc[0]
+        recommendations = [{'StockCode': result['Rec{}_StockCode'.format(rec)], 'Description': result['Rec{}_Description'.format(rec)]}
+                           for rec in recommendation_numbers(result.index) if isinstance(result['Rec{}_StockCode'.format(rec)], str)]
+        return {'CustomerID': float(result['CustomerID']), 'cluster': int(result['cluster']), 'recommendations': recommendations,
+                'scored': True}
+
+    def lookup(self, customer_id):
+        if not isinstance(customer_id, SCALAR_TYPES):
+            raise ValueError('customer ids must be numbers or strings, got {}'.format(json.dumps(customer_id)))
+        return self.table.get(float(customer_id))
+
+    def score(self, customer):
+        # Score an unknown customer from a dict of its feature values
+        if self.bundle is None:
+            raise ValueError('no model bundle loaded')
+        not_scalar = [column for column, value in customer.items() if not isinstance(value, SCALAR_TYPES)]
+        if not_scalar:
+            raise ValueError('feature values must be numbers, strings, booleans or null: {}'.format(', '.join(not_scalar)))
+        missing = [column for column in self.bundle.bundle['feature_columns'] if column not in customer]
+        if missing or 'CustomerID' not in customer:
+            raise ValueError('missing features: {}'.format(', '.join(['CustomerID'] * ('CustomerID' not in customer) + missing)))
+        return self.score_customer(tuple(sorted(customer.items())))
+
+
+async def watch_for_reload(service, interval):
+    # Hot reload: pick up the output and model bundle of a pipeline run as soon as it writes its ready marker
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        if service.marker_mtime() != service.loaded_marker_mtime:
+            try:
+                await loop.run_in_executor(None, service.reload)
+            except (OSError, ValueError) as error:
+                print('Reload failed: {}'.format(error))
+
+
+async def handle_request(service, method, path, body):
+    loop = asyncio.get_running_loop()
+    parts = [part for part in path.split('?')[0].split('/') if part]
+
+    if method == 'GET' and parts == ['health']:
+        return 200, {'status': 'ok', 'customers': len(service.table)}
+    if method == 'GET' and len(parts) == 2 and parts[0] == 'recommend':
+        record = service.lookup(parts[1])
+        return (200, record) if record else (404, {'error': 'unknown customer', 'CustomerID': parts[1]})
+    if method == 'GET' and len(parts) == 2 and parts[0] == 'clusters':
+        top_products = service.top_products.get(int(parts[1]))
+        return (200, {'cluster': int(parts[1]), 'top_products': top_products}) if top_products else (404, {'error': 'unknown cluster'})
+    if method == 'POST' and parts == ['recommend']:
+        # Batch lookups by id, plus on-the-fly scoring of customers sent with their features
+        request = json.loads(body or b'{}')
+        results = [service.lookup(customer_id) or {'CustomerID': customer_id, 'error': 'unknown customer'}
+                   for customer_id in request.get('customer_ids', [])]
+        for customer in request.get('customers', []):
+            if not isinstance(customer, dict):
+                raise ValueError('customers must be objects of feature values')
+            known = service.lookup(customer.get('CustomerID', float('nan')))
+            results.append(known or await loop.run_in_executor(None, service.score, customer))
+        return 200, {'results': results}
+    if method == 'POST' and parts == ['reload']:
+        await loop.run_in_executor(None, service.reload)
+        return 200, {'status': 'reloaded', 'customers': len(service.table)}
+    return (405, {'error': 'method not allowed'}) if parts and parts[0] in ('recommend', 'reload') else (404, {'error': 'not found'})
+
+
+async def handle_connection(service, reader, writer):
+    # Serve HTTP/1.1 requests on a keep-alive connection until the client closes it
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            try:
+                status, payload = await handle_request(service, method, path, body)
+            except (ValueError, KeyError) as error:
+                status, payload = 400, {'error': str(error)}
+            except Exception as error:
+                status, payload = 500, {'error': str(error)}
+
+            content = json.dumps(payload).encode()
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                status, REASONS[status], len(content), 'keep-alive' if keep_alive else 'close').encode() + content)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(recommendations_path='output.csv', bundle_path='model_bundle.pkl', host='127.0.0.1', port=8000,
+                cache_size=10000, reload_interval=2.0):
+    service = RecommendationService(recommendations_path, bundle_path, cache_size)
+    service.reload()
+    server = await asyncio.start_server(functools.partial(handle_connection, service), host, port)
+    watcher = asyncio.create_task(watch_for_reload(service, reload_interval))
+    print('Serving recommendations on http://{}:{}'.format(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+
+async def generate_load(customer_ids, host='127.0.0.1', port=8000, requests=10000, concurrency=32, seed=0):
+    # Send GET /recommend/<CustomerID> requests over `concurrency` keep-alive connections and record every latency
+    rng = random.Random(seed)
+    latencies, statuses = [], {}
+    remaining = [requests]
+
+    async def worker():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                request = 'GET /recommend/{} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(rng.choice(customer_ids), host).encode()
+                start = time.perf_counter()
+                writer.write(request)
+                await writer.drain()
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line == b'\r\n':
+                        break
+                    if line.lower().startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    percentile = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {'requests': len(latencies), 'seconds': elapsed, 'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(0.50), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99), 'statuses': statuses}
@@ -0,0 +1,148 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Instrumentation around the RecommendationSystem stages: wall time, CPU time, peak traced memory and the shape of
+# the frame each stage reads and writes, with an optional cProfile capture per stage. Only the standard library is used.
+
+# Stage -> (frame attribute it reads, frame attribute it writes)
+STAGE_FRAMES = {
+    'load_data': (None, 'df'),
+    'load_clean_data': (None, 'df'),
+    'clean_data': ('df', 'df'),
+    'build_interaction_index': ('df', 'df'),
+    'feature_engineer': ('df', 'customer_data'),
+    'feature_engineer_incremental': ('df', 'customer_data'),
+    'fix_outlier': ('customer_data', 'customer_data_cleaned'),
+    'feature_scale': ('customer_data_cleaned', 'customer_data_scaled'),
+    'dimensionality_reduction': ('customer_data_scaled', 'customer_data_pca'),
+    'select_k': ('customer_data_pca', None),
+    'kmeans_clustering': ('customer_data_pca', 'customer_data_pca'),
+    'recommendation_system': ('customer_data_cleaned', 'customer_data_with_recommendations'),
+    'save_model_bundle': (None, None),
+    'generate_output_csv': ('customer_data_with_recommendations', None),
+}
+
+
+def frame_shape(rec_system, attribute):
+    frame = getattr(rec_system, attribute, None) if attribute else None
+    return list(frame.shape) if hasattr(frame, 'shape') else [None, None]
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process so far (ru_maxrss is in kilobytes on Linux and in bytes on macOS)
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def reset_peak_rss():
+    # Restart the peak RSS from the current RSS, so the next reading is the peak of what runs from now on. Only Linux
+    # supports this; elsewhere the peak stays process-wide and a stage's growth is how far it raised that peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+class StageProfiler:
+    def __init__(self, cprofile_dir=None, trace_memory=True):
+        self.cprofile_dir = cprofile_dir
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.stack = []
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.process_peak_rss = 0.0
+
+    def instrument(self, rec_system):
+        # Wrap every stage method on this instance, so stages are measured whoever calls them (the pipeline
+        # runner, another stage or the command line); nested stages are recorded with their depth
+        for stage in STAGE_FRAMES:
+            method = getattr(rec_system, stage)
+            setattr(rec_system, stage, functools.wraps(method)(functools.partial(self.measure, rec_system, stage, method)))
+        return rec_system
+
+    def record_cached(self, stage):
+        self.stages.append({'stage': stage, 'depth': len(self.stack), 'cached': True, 'start_seconds': time.perf_counter() - self.origin})
+
+    def measure(self, rec_system, stage, method, /, *args, **kwargs):
+        input_frame, output_frame = STAGE_FRAMES[stage]
+        record = {'stage': stage, 'depth': len(self.stack), 'cached': False, 'rows_in': frame_shape(rec_system, input_frame)[0],
+                  'columns_in': frame_shape(rec_system, input_frame)[1]}
+
+        # The traced peak is process-wide, so fold the peak so far into the enclosing stage before resetting it, and report
+        # the stage's peak above the memory already traced when it started (the frames it received and everything else
+        # still alive); tracing every allocation slows allocation-heavy stages down several times, so it can be turned off
+        frame = {'peak': 0, 'traced_start': 0, 'rss_peak': 0.0}
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            frame['traced_start'] = tracemalloc.get_traced_memory()[0]
+
+        # The same for the RSS: fold the peak so far into the enclosing stage and the process, then measure the stage's
+        # own growth above the RSS it started at
+        self.process_peak_rss = max(self.process_peak_rss, peak_rss_mb())
+        if self.stack:
+            self.stack[-1]['rss_peak'] = max(self.stack[-1]['rss_peak'], peak_rss_mb())
+        reset_peak_rss()
+        frame['rss_start'] = peak_rss_mb()
+        self.stack.append(frame)
+
+        # cProfile cannot nest, so only top-level stages are captured (their nested stages are included in them)
+        profile = cProfile.Profile() if self.cprofile_dir and len(self.stack) == 1 else None
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            if profile:
+                profile.enable()
+            return method(*args, **kwargs)
+        finally:
+            if profile:
+                profile.disable()
+            record['start_seconds'] = start - self.origin
+            record['wall_seconds'] = time.perf_counter() - start
+            record['cpu_seconds'] = time.process_time() - cpu_start
+            self.stack.pop()
+            record['peak_traced_mb'] = None
+            if self.trace_memory:
+                record['peak_traced_mb'] = (max(frame['peak'], tracemalloc.get_traced_memory()[1]) - frame['traced_start']) / 2 ** 20
+                if self.stack:
+                    self.stack[-1]['peak'] = max(self.stack[-1]['peak'], frame['peak'], tracemalloc.get_traced_memory()[1])
+                    tracemalloc.reset_peak()
+            rss_peak = max(frame['rss_peak'], peak_rss_mb())
+            record['rss_growth_mb'] = max(rss_peak - frame['rss_start'], 0.0)
+            if self.stack:
+                self.stack[-1]['rss_peak'] = max(self.stack[-1]['rss_peak'], rss_peak)
+            self.process_peak_rss = max(self.process_peak_rss, rss_peak)
+            record['peak_rss_mb'] = self.process_peak_rss
+            record['rows_out'], record['columns_out'] = frame_shape(rec_system, output_frame)
+            if profile:
+                os.makedirs(self.cprofile_dir, exist_ok=True)
+                record['cprofile'] = os.path.join(self.cprofile_dir, '{}.prof'.format(stage))
+                profile.dump_stats(record['cprofile'])
+            self.stages.append(record)
+
+    def report(self):
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'total_seconds': time.perf_counter() - self.origin, 'stages': sorted(self.stages, key=lambda stage: stage['start_seconds'])}
+
+    def write_report(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+    def write_chrome_trace(self, path):
+        # Complete ("X") events in microseconds, viewable in chrome://tracing or Perfetto; nesting follows the timestamps
+        events = [{'name': stage['stage'], 'ph': 'X', 'pid': os.getpid(), 'tid': 0, 'ts': stage['start_seconds'] * 1e6,
+                   'dur': stage.get('wall_seconds', 0) * 1e6, 'args': {key: value for key, value in stage.items() if key != 'stage'}}
+                  for stage in self.stages]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)